@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark of wgfrontend with synthetic configs of 100 to 50k peers
+
+Times the main operations of WGCfg and a full rendering of the client list
+through CherryPy (in-process, no sockets). Stub "wg" and "wg-quick" tools are
+put first in PATH so that it runs offline. Results can be saved and compared
+against a previous run to catch regressions:
+python3 benchmarks/bench_wgfrontend.py --save baseline.json
+python3 benchmarks/bench_wgfrontend.py --compare baseline.json
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import cherrypy
+
+import synthconf
+from wgfrontend import config
+from wgfrontend import metrics
+from wgfrontend import procpool
+from wgfrontend import pwdtools
+from wgfrontend import webapp
+
+
+STUB_WG = '''\
+#!{python}
+# Stub of the wg tool for benchmarking
+import base64, hashlib, os, sys
+command = sys.argv[1] if len(sys.argv) > 1 else ''
+if command in ['genkey', 'genpsk']:
+    print(base64.standard_b64encode(os.urandom(32)).decode('ascii'))
+elif command == 'pubkey':
+    print(base64.standard_b64encode(hashlib.sha256(sys.stdin.read().strip().encode()).digest()).decode('ascii'))
+elif command == 'show':
+    print('private\\tpublic\\t51820\\toff')
+elif (command in ['set', 'syncconf']) and not sys.stdin.isatty():
+    sys.stdin.read()
+'''
+
+STUB_WG_QUICK = '''\
+#!/bin/sh
+# Stub of wg-quick for benchmarking
+exit 0
+'''
+
+DEFAULT_SIZES = [100, 1000, 10000, 50000]
+
+
+class BenchConfiguration(config.Configuration):
+    """Configuration with the lib directory in the temporary directory"""
+
+    def __init__(self, libdir):
+        self._libdir = libdir
+
+    @property
+    def libdir(self):
+        return self._libdir
+
+
+def install_stubs(bindir):
+    """Create the stub tools and put them first in PATH"""
+    os.makedirs(bindir, exist_ok=True)
+    for name, content in [('wg', STUB_WG.format(python=sys.executable)), ('wg-quick', STUB_WG_QUICK)]:
+        filename = os.path.join(bindir, name)
+        with open(filename, 'w') as f:
+            f.write(content)
+        os.chmod(filename, 0o755)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ.get('PATH', '')
+
+def write_frontend_config(tmpdir, wg_configfile, key_backend):
+    """Write a wgfrontend.conf for the benchmark and return a configuration object reading it"""
+    config.config_filename = os.path.join(tmpdir, 'wgfrontend.conf')
+    with open(config.config_filename, 'w') as f:
+        f.write(f'[general]\n'
+                f'wg_configfile = {wg_configfile}\n'
+                f'on_change_command = "wg-quick down {wg_configfile}; wg-quick up {wg_configfile}"\n'
+                f'wg_command = wg\n'
+                f'key_backend = {key_backend}\n'
+                f'status_interval = 0\n'
+                f'backup_count = 0\n'
+                f'\n[users]\n'
+                f'admin = {pwdtools.hash_password("benchmark")}\n')
+    return BenchConfiguration(os.path.join(tmpdir, 'lib'))
+
+def measure(func, min_time=0.2, min_runs=3, max_runs=1000):
+    """Run the function repeatedly and return the median duration in seconds"""
+    durations = []
+    start = time.perf_counter()
+    while (len(durations) < max_runs) and ((len(durations) < min_runs) or (time.perf_counter() - start < min_time)):
+        t = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - t)
+    return statistics.median(durations)
+
+def request(path):
+    """Handle a GET request in-process and return the status and the length of the body"""
+    app = cherrypy.tree.apps['']
+    local = cherrypy.lib.httputil.Host('127.0.0.1', 8080, '')
+    remote = cherrypy.lib.httputil.Host('127.0.0.1', 50000, '')
+    req, resp = app.get_serving(local, remote, 'http', 'HTTP/1.1')
+    try:
+        path, _, query_string = path.partition('?')
+        resp = req.run('GET', path, query_string, 'HTTP/1.1', [('Host', 'localhost')], io.BytesIO(b''))
+        body = b''.join(resp.body)
+        if not resp.status.startswith('200'):
+            raise RuntimeError(f'Request [{path}] failed with [{resp.status}]')
+        return len(body)
+    finally:
+        app.release_serving()
+
+def bench_size(tmpdir, count, key_backend, network6=None):
+    """Run all benchmarks for a config with the given number of peers; returns a dictionary of durations"""
+    results = dict()
+    wg_configfile = os.path.join(tmpdir, f'wgbench{count}.conf')
+    synthconf.write_config(wg_configfile, count, seed=count, network6=network6)
+    cfg = write_frontend_config(tmpdir, wg_configfile, key_backend)
+    start = time.perf_counter()
+    app = webapp.WebApp(cfg)
+    results['load'] = time.perf_counter() - start
+    wg = app.interfaces.default.wg
+    ids = [ peerdata['Id'] for peer, peerdata in wg.get_peers_page(limit=count)[1] ]
+    peers = list(wg.get_peers())
+
+    results['get_peers'] = measure(wg.get_peers)
+    results['get_peer_byid'] = measure(lambda: wg.get_peer_byid(random.choice(ids)))
+    results['find_free_ip'] = measure(wg.find_free_ip)
+    results['get_peerconfig'] = measure(lambda: wg.get_peerconfig(random.choice(peers)))
+    created = []
+    results['create_peer'] = measure(lambda: created.append(wg.create_peer('Benchmark peer')), max_runs=50)
+    results['delete_peer'] = measure(lambda: wg.delete_peer(created.pop()), max_runs=len(created))
+    app.interfaces.stop()
+
+    cherrypy.tree.mount(app, '', config={'/': {'tools.sessions.on': True, 'tools.reload_wgconfig.on': True}})
+    last_page = (count + 49) // 50
+    results['index'] = measure(lambda: request('/'))
+    results['index_last_page'] = measure(lambda: request(f'/?page={last_page}&sort=-address'))
+    results['index_search'] = measure(lambda: request('/?search=user00042'))
+    metrics.unregister_gauges()
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print the operations that got slower than the baseline by more than the tolerance factor; returns their number"""
+    regressions = 0
+    for key, duration in sorted(results.items()):
+        previous = baseline.get(key)
+        if previous and (duration > previous * tolerance):
+            print(f'REGRESSION {key}: {previous * 1e6:.1f}us -> {duration * 1e6:.1f}us')
+            regressions += 1
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.partition('\n')[0])
+    parser.add_argument('--sizes', type=lambda value: [ int(size) for size in value.split(',') ], default=DEFAULT_SIZES,
+                        help='comma-separated numbers of peers (default: 100,1000,10000,50000)')
+    parser.add_argument('--key-backend', default='auto', help='key backend to use ("wg" uses the stub tool)')
+    parser.add_argument('--network6', metavar='NETWORK', help='benchmark dual-stack peers with IPv6 addresses from this network (e.g. fd00::/64)')
+    parser.add_argument('--save', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with results saved before')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='factor by which an operation may be slower than the baseline')
+    args = parser.parse_args()
+    cherrypy.config.update({'environment': 'embedded', 'log.screen': False})
+    cherrypy.server.unsubscribe() # requests are handled in-process
+    cherrypy.engine.start()
+    results = dict()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            install_stubs(os.path.join(tmpdir, 'bin'))
+            print(f'{"peers":>7} {"operation":<16} {"median":>12}')
+            for count in args.sizes:
+                for operation, duration in bench_size(tmpdir, count, args.key_backend, args.network6).items():
+                    print(f'{count:>7} {operation:<16} {duration * 1000:>10.3f}ms')
+                    results[f'{count}/{operation}'] = duration
+    finally:
+        cherrypy.engine.exit()
+        procpool.shutdown()
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        print(f'{regressions} regression(s)')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Stress test for concurrent use of a WGCfg instance by many threads
+
+Creates, updates and deletes peers from dozens of threads while other threads
+read, and checks that no address is allocated twice and no torn data is seen.
+Runs offline on a temporary config file: python3 benchmarks/stress_wgcfg.py
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from wgfrontend import wgcfg
+
+
+INITIAL_CONFIG = '''\
+[Interface]
+ListenPort = 51820
+# Endpoint = vpn.example.com:51820
+PrivateKey = 8ByVz5mQYV5H3tVlcr0bUB0ZXzYq7pJ2J6nVvJE5nUE=
+# Networks = 192.168.0.0/16
+Address = 10.10.0.1/16
+'''
+
+
+def check_snapshot(peers, errors):
+    """Check a snapshot of the client data for consistency"""
+    addresses = collections.Counter(peerdata['Address'] for peerdata in peers.values())
+    duplicates = [ address for address, count in addresses.items() if count > 1 ]
+    if duplicates:
+        errors.append(f'Duplicate addresses: {duplicates}')
+    for peer, peerdata in peers.items():
+        if (peerdata['PublicKey'] != peer) or (peerdata['Id'] != peerdata['Address'].partition('/')[0].replace('.', '-')):
+            errors.append(f'Inconsistent client data: {peerdata}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.partition('\n')[0])
+    parser.add_argument('--threads', type=int, default=32, help='number of writing threads')
+    parser.add_argument('--readers', type=int, default=16, help='number of reading threads')
+    parser.add_argument('--operations', type=int, default=30, help='operations per writing thread')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'wg_stress.conf')
+        with open(filename, 'w') as f:
+            f.write(INITIAL_CONFIG)
+        wg = wgcfg.WGCfg(filename, tmpdir, backup_count=0)
+        errors = []
+        created = collections.Counter()
+        done = threading.Event()
+
+        def writer(number):
+            mine = []
+            for i in range(args.operations):
+                choice = random.random()
+                if (choice < 0.6) or not mine:
+                    peer = wg.create_peer(f'stress {number}-{i}')
+                    mine.append(peer)
+                    created[number] += 1
+                elif choice < 0.8:
+                    wg.update_peer(random.choice(mine), f'stress {number}-{i} updated')
+                else:
+                    wg.delete_peer(mine.pop(random.randrange(len(mine))))
+
+        def reader():
+            while not done.is_set():
+                check_snapshot(wg.get_peers(), errors)
+                wg.get_peerstates()
+
+        readers = [ threading.Thread(target=reader) for i in range(args.readers) ]
+        writers = [ threading.Thread(target=writer, args=(i,)) for i in range(args.threads) ]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        check_snapshot(wg.get_peers(), errors)
+        on_disk = wgcfg.WGCfg(filename, tmpdir, backup_count=0).get_peers()
+        if on_disk != wg.get_peers():
+            errors.append('Config file on disk differs from the data in memory')
+        print(f'{sum(created.values())} peers created, {len(on_disk)} remaining, {wg.store.commits} writes, {len(errors)} error(s)')
+        for error in errors[:10]:
+            print('  ' + error)
+        return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Generator for synthetic WireGuard config files with many peers
+
+Writes a server config in the layout created by wgfrontend (description
+comment, public key, commented private key, preshared key, address):
+python3 benchmarks/synthconf.py 10000 /tmp/wg_bench.conf
+"""
+
+import argparse
+import base64
+import ipaddress
+import os
+import random
+
+
+def random_key():
+    """Get a random key in WireGuard's base64 format (not a valid key pair, which isn't needed here)"""
+    return base64.standard_b64encode(os.urandom(32)).decode('ascii')
+
+def generate_config(count, network='10.0.0.0/16', seed=None, network6=None):
+    """Get the content of a config file with "count" peers in the given network; with "network6", peers are dual-stack
+       and get IPv6 addresses scattered across that network (like hashed interface IDs)"""
+    rng = random.Random(seed)
+    network = ipaddress.ip_network(network)
+    if count > network.num_addresses - 3:
+        raise ValueError(f'Network [{network}] is too small for {count} peers')
+    hosts = network.hosts()
+    server_address = next(hosts)
+    addresses = f'{server_address}/{network.prefixlen}'
+    if network6 is not None:
+        network6 = ipaddress.ip_network(network6)
+        addresses += f', {network6.network_address + 1}/{network6.prefixlen}'
+    lines = ['[Interface]',
+             'ListenPort = 51820',
+             '# Endpoint = vpn.example.com:51820',
+             f'PrivateKey = {random_key()}',
+             '# Networks = 192.168.0.0/16',
+             f'Address = {addresses}',
+            ]
+    words = ['Laptop', 'Phone', 'Tablet', 'Desktop', 'Router', 'Server']
+    for i in range(count):
+        allowed_ips = f'{next(hosts)}/32'
+        if network6 is not None:
+            allowed_ips += f', {network6.network_address + rng.randrange(2, network6.num_addresses)}/128'
+        lines.extend(['',
+                      f'# {rng.choice(words)} of user{i:05d}',
+                      '[Peer]',
+                      f'PublicKey = {random_key()}',
+                      f'# PrivateKey = {random_key()}',
+                      f'PresharedKey = {random_key()}',
+                      f'AllowedIPs = {allowed_ips}',
+                      'PersistentKeepalive = 25',
+                     ])
+    return '\n'.join(lines) + '\n'
+
+def write_config(filename, count, network='10.0.0.0/16', seed=None, network6=None):
+    """Write a config file with "count" peers"""
+    with open(filename, 'w') as f:
+        f.write(generate_config(count, network, seed, network6))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.partition('\n')[0])
+    parser.add_argument('count', type=int, help='number of peers')
+    parser.add_argument('filename', help='config file to write')
+    parser.add_argument('--network', default='10.0.0.0/16', help='network of the interface')
+    parser.add_argument('--network6', default=None, help='IPv6 network of the interface for dual-stack peers (e.g. fd00::/64)')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the descriptions')
+    args = parser.parse_args()
+    write_config(args.filename, args.count, args.network, args.seed, args.network6)
+
+
+if __name__ == '__main__':
+    main()
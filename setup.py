@@ -22,10 +22,12 @@ setup_kwargs = {
                          'qrcode[pil]',
                          'wgconfig'
                         ],
+    'extras_require': {'crypto': ['cryptography'], 'brotli': ['brotli']},
     'entry_points': '''
         [console_scripts]
         wgfrontend=wgfrontend:main
         wgfrontend-password=wgfrontend.pwdtools:hash_password_interactively
+        wgfrontend-token=wgfrontend.apitokens:generate_token_interactively
     ''',
     'classifiers': [
         'Programming Language :: Python',
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+"""Allocator for the client addresses within the network of the WireGuard interface"""
+
+import bisect
+import ipaddress
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+FREE = 0
+USED = 1
+RESERVED = 2
+
+MAX_MAP_SIZE = 2**20 # larger networks (like IPv6 prefixes) are tracked by a SparseAddressPool
+
+
+def parse_ranges(ranges):
+    """Parse a comma-separated string of addresses, networks and ranges ("first-last") into a list of (first, last) address tuples"""
+    result = []
+    if not ranges:
+        return result
+    for item in ranges.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '-' in item:
+            first, _, last = item.partition('-')
+            first = ipaddress.ip_address(first.strip())
+            last = ipaddress.ip_address(last.strip())
+        elif '/' in item:
+            network = ipaddress.ip_network(item, strict=False)
+            first, last = network.network_address, network.broadcast_address
+        else:
+            first = last = ipaddress.ip_address(item)
+        if first > last:
+            raise ValueError(f'Invalid address range [{item}]')
+        result.append((first, last))
+    return result
+
+
+class AddressPool():
+    """Keeps track of used addresses of a network in a byte map (one byte per address)"""
+
+    def __init__(self, network, reserved=None):
+        """Initialize the pool for the given network; "reserved" is a list of (first, last) tuples or a string as understood by parse_ranges()"""
+        self.network = ipaddress.ip_network(network, strict=False)
+        self._base = int(self.network.network_address)
+        self._address_class = type(self.network.network_address)
+        self._map = bytearray(self.network.num_addresses)
+        self._lowest_free = 0 # all addresses below this offset are known to be in use
+        self.used = 0
+        self.reserved = 0
+        if self.network.num_addresses > 2:
+            # Network and broadcast address are not usable for hosts (same as in "network.hosts()")
+            self._set(0, RESERVED)
+            if self.network.version == 4:
+                self._set(self.network.num_addresses - 1, RESERVED)
+        if isinstance(reserved, str):
+            reserved = parse_ranges(reserved)
+        for first, last in reserved or []:
+            self.reserve(first, last)
+
+    def _offset(self, address):
+        """Get the offset of the given address within the network or None if it is not part of it"""
+        try:
+            offset = int(self._address_class(address)) - self._base
+        except ValueError: # not an address of the IP version of the network
+            return None
+        if (offset < 0) or (offset >= len(self._map)):
+            return None
+        return offset
+
+    def _set(self, offset, state):
+        """Set the state of the address with the given offset and update the counters"""
+        previous = self._map[offset]
+        if previous == state:
+            return
+        if previous == USED:
+            self.used -= 1
+        elif previous == RESERVED:
+            self.reserved -= 1
+        if state == USED:
+            self.used += 1
+        elif state == RESERVED:
+            self.reserved += 1
+        self._map[offset] = state
+        if (state == FREE) and (offset < self._lowest_free):
+            self._lowest_free = offset
+
+    def reserve(self, first, last=None):
+        """Reserve the given address (or range of addresses) so that it is never allocated"""
+        if ipaddress.ip_address(first).version != self.network.version:
+            return
+        first_offset = max(int(ipaddress.ip_address(first)) - self._base, 0)
+        last_offset = int(ipaddress.ip_address(last if last is not None else first)) - self._base
+        last_offset = min(last_offset, len(self._map) - 1)
+        for offset in range(first_offset, last_offset + 1):
+            self._set(offset, RESERVED)
+
+    def mark_used(self, address):
+        """Mark the given address as being in use; addresses outside of the network are ignored"""
+        offset = self._offset(address)
+        if offset is None:
+            return False
+        if self._map[offset] == FREE:
+            self._set(offset, USED)
+        return True
+
+    def release(self, address):
+        """Mark the given address as being free again"""
+        offset = self._offset(address)
+        if (offset is not None) and (self._map[offset] == USED):
+            self._set(offset, FREE)
+
+    def is_free(self, address):
+        """Check whether the given address is part of the network and can be allocated"""
+        offset = self._offset(address)
+        return (offset is not None) and (self._map[offset] == FREE)
+
+    def find_free(self, count=1, exclude=()):
+        """Get a list of the lowest "count" free addresses without allocating them; the addresses in "exclude" are skipped"""
+        excluded = set(self._offset(address) for address in exclude)
+        result = []
+        offset = self._lowest_free
+        searching = True
+        while len(result) < count:
+            offset = self._map.find(FREE, offset)
+            if offset < 0:
+                raise ValueError('No free IP address available any more')
+            if searching:
+                self._lowest_free = offset
+                searching = False
+            if offset not in excluded:
+                result.append(offset)
+            offset += 1
+        return [ ipaddress.ip_address(self._base + offset) for offset in result ]
+
+    def allocate(self, count=1):
+        """Allocate the lowest "count" free addresses and return them as a list"""
+        addresses = self.find_free(count)
+        for address in addresses:
+            self._set(int(address) - self._base, USED)
+        return addresses
+
+    @property
+    def size(self):
+        """Number of addresses in the pool that may be used by hosts"""
+        return len(self._map) - self.reserved
+
+    @property
+    def available(self):
+        """Number of addresses that can still be allocated"""
+        return self.size - self.used
+
+    @property
+    def utilization(self):
+        """Share of usable addresses that are in use"""
+        if self.size <= 0:
+            return 1.0
+        return self.used / self.size
+
+
+class SparseAddressPool():
+    """Keeps track of used addresses of a (possibly huge) network in a sorted list of offsets so that memory and time
+       depend on the number of peers instead of the size of the network; reserved ranges are kept as sorted intervals"""
+
+    def __init__(self, network, reserved=None):
+        """Initialize the pool for the given network; "reserved" is a list of (first, last) tuples or a string as understood by parse_ranges()"""
+        self.network = ipaddress.ip_network(network, strict=False)
+        self._base = int(self.network.network_address)
+        self._address_class = type(self.network.network_address)
+        self._size = self.network.num_addresses
+        self._used = [] # sorted offsets of the used addresses
+        self._reserved = [] # sorted, disjoint (first, last) offset intervals
+        self._lowest_free = 0 # all addresses below this offset are known to be in use
+        self.reserved = 0
+        if self._size > 2:
+            # Network and broadcast address are not usable for hosts (same as in "network.hosts()")
+            self._reserve_offsets(0, 0)
+            if self.network.version == 4:
+                self._reserve_offsets(self._size - 1, self._size - 1)
+        if isinstance(reserved, str):
+            reserved = parse_ranges(reserved)
+        for first, last in reserved or []:
+            self.reserve(first, last)
+
+    def _offset(self, address):
+        """Get the offset of the given address within the network or None if it is not part of it"""
+        try:
+            offset = int(self._address_class(address)) - self._base
+        except ValueError: # not an address of the IP version of the network
+            return None
+        if (offset < 0) or (offset >= self._size):
+            return None
+        return offset
+
+    def _find_reserved(self, offset):
+        """Get the reserved interval containing the given offset or None"""
+        i = bisect.bisect_right(self._reserved, (offset, self._size)) - 1
+        if (i >= 0) and (self._reserved[i][1] >= offset):
+            return self._reserved[i]
+        return None
+
+    def _is_used(self, offset):
+        """Check whether the given offset is in the list of used addresses"""
+        i = bisect.bisect_left(self._used, offset)
+        return (i < len(self._used)) and (self._used[i] == offset)
+
+    def _reserve_offsets(self, first, last):
+        """Merge the given interval of offsets into the reserved intervals; used addresses in it count as reserved from now on"""
+        i = bisect.bisect_left(self._reserved, (first, first))
+        if (i > 0) and (self._reserved[i - 1][1] >= first - 1):
+            i -= 1
+        j = i
+        while (j < len(self._reserved)) and (self._reserved[j][0] <= last + 1):
+            first = min(first, self._reserved[j][0])
+            last = max(last, self._reserved[j][1])
+            self.reserved -= self._reserved[j][1] - self._reserved[j][0] + 1
+            j += 1
+        self._reserved[i:j] = [(first, last)]
+        self.reserved += last - first + 1
+        del self._used[bisect.bisect_left(self._used, first):bisect.bisect_right(self._used, last)]
+
+    def reserve(self, first, last=None):
+        """Reserve the given address (or range of addresses) so that it is never allocated"""
+        if ipaddress.ip_address(first).version != self.network.version:
+            return
+        first_offset = max(int(ipaddress.ip_address(first)) - self._base, 0)
+        last_offset = int(ipaddress.ip_address(last if last is not None else first)) - self._base
+        last_offset = min(last_offset, self._size - 1)
+        if first_offset <= last_offset:
+            self._reserve_offsets(first_offset, last_offset)
+
+    def mark_used(self, address):
+        """Mark the given address as being in use; addresses outside of the network are ignored"""
+        offset = self._offset(address)
+        if offset is None:
+            return False
+        if (self._find_reserved(offset) is None) and not self._is_used(offset):
+            bisect.insort(self._used, offset)
+        return True
+
+    def release(self, address):
+        """Mark the given address as being free again"""
+        offset = self._offset(address)
+        if offset is None:
+            return
+        i = bisect.bisect_left(self._used, offset)
+        if (i < len(self._used)) and (self._used[i] == offset):
+            del self._used[i]
+            if offset < self._lowest_free:
+                self._lowest_free = offset
+
+    def is_free(self, address):
+        """Check whether the given address is part of the network and can be allocated"""
+        offset = self._offset(address)
+        return (offset is not None) and (self._find_reserved(offset) is None) and not self._is_used(offset)
+
+    def _next_free(self, offset):
+        """Get the lowest free offset not below the given one (searching the gaps between used and reserved addresses) or None"""
+        i = bisect.bisect_left(self._used, offset)
+        while offset < self._size:
+            interval = self._find_reserved(offset)
+            if interval is not None:
+                offset = interval[1] + 1
+                i = bisect.bisect_left(self._used, offset, i)
+            elif (i < len(self._used)) and (self._used[i] == offset):
+                offset += 1
+                i += 1
+            else:
+                return offset
+        return None
+
+    def find_free(self, count=1, exclude=()):
+        """Get a list of the lowest "count" free addresses without allocating them; the addresses in "exclude" are skipped"""
+        excluded = set(self._offset(address) for address in exclude)
+        result = []
+        offset = self._lowest_free
+        searching = True
+        while len(result) < count:
+            offset = self._next_free(offset)
+            if offset is None:
+                raise ValueError('No free IP address available any more')
+            if searching:
+                self._lowest_free = offset
+                searching = False
+            if offset not in excluded:
+                result.append(offset)
+            offset += 1
+        return [ ipaddress.ip_address(self._base + offset) for offset in result ]
+
+    def allocate(self, count=1):
+        """Allocate the lowest "count" free addresses and return them as a list"""
+        addresses = self.find_free(count)
+        for address in addresses:
+            bisect.insort(self._used, int(address) - self._base)
+        return addresses
+
+    @property
+    def used(self):
+        """Number of addresses in use"""
+        return len(self._used)
+
+    @property
+    def size(self):
+        """Number of addresses in the pool that may be used by hosts"""
+        return self._size - self.reserved
+
+    @property
+    def available(self):
+        """Number of addresses that can still be allocated"""
+        return self.size - self.used
+
+    @property
+    def utilization(self):
+        """Share of usable addresses that are in use"""
+        if self.size <= 0:
+            return 1.0
+        return self.used / self.size
+
+
+def create_pool(network, reserved=None):
+    """Create the address pool suitable for the size of the given network"""
+    network = ipaddress.ip_network(network, strict=False)
+    if network.num_addresses <= MAX_MAP_SIZE:
+        return AddressPool(network, reserved)
+    return SparseAddressPool(network, reserved)
+
+
+if __name__ == '__main__':
+    import timeit
+    pool = AddressPool('10.0.0.1/16', reserved='10.0.0.1, 10.0.1.0/24')
+    pool.allocate(60000)
+    print(pool.used, pool.available, pool.find_free(2))
+    print(timeit.timeit(lambda: pool.find_free(), number=1000) / 1000)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""JSON API for managing peers, authenticated by API tokens"""
+
+import cherrypy
+import json
+
+from . import apitokens
+from . import wgcfg
+
+
+PUBLIC_FIELDS = ['Id', 'Description', 'Address', 'Address6', 'PublicKey']
+
+
+def check_api_token():
+    """Authenticate the request by the bearer token in the Authorization header"""
+    scheme, _, token = cherrypy.request.headers.get('Authorization', '').partition(' ')
+    name = None
+    if (scheme.lower() == 'bearer') and token.strip():
+        name = cherrypy.request.app.root.api.token_names.get(apitokens.hash_token(token.strip()))
+    if name is None:
+        cherrypy.response.headers['WWW-Authenticate'] = 'Bearer realm="wgfrontend"'
+        raise cherrypy.HTTPError(401, 'Invalid or missing API token')
+    cherrypy.request.login = name
+
+cherrypy.tools.api_token = cherrypy.Tool('before_handler', check_api_token, priority=50) # before reload_wgconfig
+
+def json_error_page(status, message, traceback, version):
+    """Render errors of the API as JSON"""
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return json.dumps({ 'status': status, 'message': message })
+
+
+class Api():
+    """Root of the JSON API"""
+
+    def __init__(self, interfaces, api_tokens):
+        """Initialize with the interface registry and the dictionary of API token names and hashes"""
+        self.token_names = { token_hash.strip(): name for name, token_hash in api_tokens.items() } # hash -> name
+        self.peers = PeersApi(interfaces)
+
+
+@cherrypy.expose
+class PeersApi():
+    """Resource /api/peers (to be used with the MethodDispatcher); the query parameter "interface" selects
+       the WireGuard interface (the first configured one by default)"""
+
+    def __init__(self, interfaces):
+        """Initialize with the interface registry"""
+        self.interfaces = interfaces
+
+    def get_wg(self, interface):
+        """Get the WireGuard config object of the given interface (404 if it doesn't exist)"""
+        try:
+            return self.interfaces.get(interface).wg
+        except KeyError:
+            raise cherrypy.NotFound()
+
+    @staticmethod
+    def get_peer(wg, id):
+        """Get the public key and client data of the peer with the given identifier (404 if it doesn't exist)"""
+        peer, peerdata = wg.get_peer_byid(id)
+        if peer is None:
+            raise cherrypy.NotFound()
+        return peer, peerdata
+
+    @staticmethod
+    def get_peer_etag(config, peerdata):
+        """Get the entity tag for the given client config and client data (the config depends on the interface settings as well)"""
+        return '"' + wgcfg.get_config_hash(config + json.dumps(peerdata, sort_keys=True)) + '"'
+
+    def set_peer_etag(self, wg, peer):
+        """Set the ETag header for the given peer; returns its client config and client data"""
+        config, peerdata = wg.get_peerconfig(peer)
+        cherrypy.response.headers['ETag'] = self.get_peer_etag(config, peerdata)
+        return config, peerdata
+
+    @staticmethod
+    def get_json_body(*fields):
+        """Get the given fields from the JSON request body (all fields are strings; None if missing)"""
+        body = getattr(cherrypy.request, 'json', None)
+        if not isinstance(body, dict):
+            raise cherrypy.HTTPError(400, 'JSON object expected')
+        values = [ body.get(field) for field in fields ]
+        for field, value in zip(fields, values):
+            if (value is not None) and not isinstance(value, str):
+                raise cherrypy.HTTPError(400, f'{field} must be a string')
+        return values
+
+    @cherrypy.tools.json_out()
+    def GET(self, id=None, interface=None, search='', sort='description', offset=0, limit=100):
+        """List the peers or get a single peer (incl. keys and client config)"""
+        wg = self.get_wg(interface)
+        if id is None:
+            cherrypy.response.headers['ETag'] = wg.get_config_etag()
+            cherrypy.lib.cptools.validate_etags() # responds with "304 Not Modified" if the ETag matches
+            if sort.lstrip('-') not in wgcfg.SORT_KEYS:
+                raise cherrypy.HTTPError(400, f'Unknown sort order [{sort}]')
+            try:
+                offset, limit = max(int(offset), 0), min(max(int(limit), 0), 10000)
+            except ValueError:
+                raise cherrypy.HTTPError(400, 'Offset and limit must be integers')
+            total, peers = wg.get_peers_page(search=search, sort=sort, offset=offset, limit=limit)
+            return { 'total': total, 'offset': offset, 'peers': [ { field: peerdata[field] for field in PUBLIC_FIELDS } for peer, peerdata in peers ] }
+        peer, peerdata = self.get_peer(wg, id)
+        config, peerdata = self.set_peer_etag(wg, peer)
+        cherrypy.lib.cptools.validate_etags()
+        return dict(peerdata, Config=config)
+
+    @cherrypy.tools.json_out()
+    def POST(self, interface=None):
+        """Create a peer from {"Description": ..., "Address": ... (optional)}"""
+        wg = self.get_wg(interface)
+        description, address = self.get_json_body('Description', 'Address')
+        if not description:
+            raise cherrypy.HTTPError(400, 'Description required')
+        try:
+            peer = wg.create_peer(description, address.partition('/')[0] if address else None)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        config, peerdata = self.set_peer_etag(wg, peer)
+        cherrypy.response.status = 201
+        cherrypy.response.headers['Location'] = cherrypy.url('/api/peers/' + peerdata['Id'], qs=f'interface={interface}' if interface else '')
+        return peerdata
+
+    @cherrypy.tools.json_out()
+    def PUT(self, id, interface=None):
+        """Update the description of a peer from {"Description": ...}; supports If-Match"""
+        wg = self.get_wg(interface)
+        peer, peerdata = self.get_peer(wg, id)
+        self.set_peer_etag(wg, peer)
+        cherrypy.lib.cptools.validate_etags() # responds with "412 Precondition Failed" if If-Match doesn't match
+        description, = self.get_json_body('Description')
+        if not description:
+            raise cherrypy.HTTPError(400, 'Description required')
+        try:
+            wg.update_peer(peer, description)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        config, peerdata = self.set_peer_etag(wg, peer)
+        return peerdata
+
+    def DELETE(self, id, interface=None):
+        """Delete a peer; supports If-Match"""
+        wg = self.get_wg(interface)
+        peer, peerdata = self.get_peer(wg, id)
+        self.set_peer_etag(wg, peer)
+        cherrypy.lib.cptools.validate_etags()
+        wg.delete_peer(peer)
+        del cherrypy.response.headers['ETag']
+        cherrypy.response.status = 204
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+"""Generation and checking of tokens for authenticating at the JSON API"""
+
+import hashlib
+import secrets
+
+
+TOKEN_PREFIX = 'wgf_'
+
+
+def generate_token():
+    """Generate a new random API token"""
+    return TOKEN_PREFIX + secrets.token_urlsafe(32)
+
+def hash_token(token):
+    """Hash an API token for storing (tokens are random, so a fast hash suffices)"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def generate_token_interactively():
+    """Ask for a token name and print a new token together with the config line to add"""
+    name = input('Please enter a name for the API token: ').strip() or 'automation'
+    token = generate_token()
+    print('API token (pass as "Authorization: Bearer <token>"; it is not shown again):')
+    print(token)
+    print('Add the following line to the [api_tokens] section of wgfrontend.conf:')
+    print(f'{name} = {hash_token(token)}')
+
+
+if __name__ == '__main__':
+    generate_token_interactively()
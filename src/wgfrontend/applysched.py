@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""Scheduler for applying config changes on a background worker"""
+
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class ApplyScheduler():
+    """Runs an apply function on a background thread, coalescing all triggers within a time window into a single run"""
+
+    def __init__(self, apply_func, delay=1.0, name='apply'):
+        """Initialize the scheduler; "apply_func" is called without arguments and returns whether it succeeded"""
+        self.apply_func = apply_func
+        self.delay = delay
+        self.name = name
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._due = None # point in time of the next scheduled run (None if nothing is pending)
+        self._running = False
+        self.triggers = 0 # number of triggers since start
+        self.runs = 0 # number of executions of the apply function
+        self.last_started = None # wall clock time of the start of the last run
+        self.last_duration = None # duration of the last run in seconds
+        self.last_success = None # result of the last run
+
+    def start(self):
+        """Start the background worker thread"""
+        with self._cond:
+            if (self._thread is not None) and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._worker, name=f'wgfrontend-{self.name}', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background worker thread after executing a pending run"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def trigger(self):
+        """Request a run; returns immediately, the run takes place after the configured delay"""
+        self.start()
+        with self._cond:
+            self.triggers += 1
+            if self._due is None: # triggers within the window are coalesced into the pending run
+                self._due = time.monotonic() + self.delay
+                self._cond.notify_all()
+
+    def _worker(self):
+        """Main loop of the background worker thread"""
+        while True:
+            with self._cond:
+                while True:
+                    if self._due is not None:
+                        remaining = self._due - time.monotonic()
+                        if (remaining <= 0) or self._stopping:
+                            break
+                        self._cond.wait(remaining)
+                    elif self._stopping:
+                        return
+                    else:
+                        self._cond.wait()
+                self._due = None
+                self._running = True
+                self.last_started = time.time()
+            started = time.monotonic()
+            try:
+                success = bool(self.apply_func())
+            except Exception as e:
+                logger.exception(f'Exception when applying config changes: [{e}]')
+                success = False
+            duration = time.monotonic() - started
+            with self._cond:
+                self._running = False
+                self.runs += 1
+                self.last_duration = duration
+                self.last_success = success
+                self._cond.notify_all()
+            logger.info(f'Config changes applied in {duration:.3f}s ({"ok" if success else "failed"})')
+
+    def wait_idle(self, timeout=None):
+        """Wait until no run is pending or running; returns whether the scheduler is idle"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while (self._due is not None) or self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if (remaining is not None) and (remaining <= 0):
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    @property
+    def state(self):
+        """Current state of the scheduler ("pending", "running" or "idle")"""
+        if self._running:
+            return 'running'
+        if self._due is not None:
+            return 'pending'
+        return 'idle'
+
+    def get_status(self):
+        """Get a dictionary describing the state and the result of the last run"""
+        with self._cond:
+            return { 'state': self.state,
+                     'triggers': self.triggers,
+                     'runs': self.runs,
+                     'last_started': self.last_started,
+                     'last_duration': self.last_duration,
+                     'last_success': self.last_success
+                   }
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Static assets with content hashes in their names (cacheable forever) and precompressed variants"""
+
+import cherrypy
+import cherrypy.lib.static
+import gzip
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+
+from . import cfgstore
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_TYPES = ['text/css', 'text/javascript', 'application/javascript', 'image/svg+xml', 'image/vnd.microsoft.icon', 'image/x-icon']
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'} # in order of preference
+
+
+def gzip_compress(data):
+    """Compress the data in gzip format (reproducibly, i.e. without timestamp)"""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as gzfile:
+        gzfile.write(data)
+    return buffer.getvalue()
+
+COMPRESSORS = {'gzip': gzip_compress}
+if brotli is not None:
+    COMPRESSORS['br'] = brotli.compress
+
+def get_hashed_name(name, content):
+    """Get the file name with a hash of the content inserted before the extension, e.g. "styles.0123456789ab.css" """
+    base, ext = os.path.splitext(name)
+    return f'{base}.{hashlib.sha256(content).hexdigest()[:12]}{ext}'
+
+
+class Assets():
+    """Builds the hashed and compressed variants of the files in the static directory and serves them"""
+
+    def __init__(self, staticdir, outdir, debug=False):
+        """Initialize for the files in "staticdir"; the variants are written to "outdir" (unless in debug mode)"""
+        self.staticdir = staticdir
+        self.outdir = outdir
+        self.debug = debug
+        self.urls = dict() # name -> hashed name
+        self.files = dict() # hashed name -> (content type, {encoding: file name})
+        if not debug:
+            self.build()
+
+    def build(self):
+        """Hash all static files and write them together with their compressed variants to the output directory"""
+        try:
+            os.makedirs(self.outdir, mode=0o755, exist_ok=True)
+        except OSError as e:
+            logger.warning(f'Could not create asset directory [{self.outdir}], serving the plain static files: [{e}]')
+            return
+        for name in sorted(os.listdir(self.staticdir)):
+            filename = os.path.join(self.staticdir, name)
+            if not os.path.isfile(filename):
+                continue
+            with open(filename, 'rb') as f:
+                content = f.read()
+            hashed_name = get_hashed_name(name, content)
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            variants = {'identity': self.write_variant(hashed_name, content)}
+            if content_type in COMPRESSIBLE_TYPES:
+                for encoding, compress in COMPRESSORS.items():
+                    compressed = compress(content)
+                    if len(compressed) < len(content) * 0.9: # only worth it if noticeably smaller
+                        variants[encoding] = self.write_variant(hashed_name + ENCODING_SUFFIXES[encoding], compressed)
+            self.urls[name] = hashed_name
+            self.files[hashed_name] = (content_type, variants)
+        self.remove_outdated()
+        logger.debug(f'Prepared {len(self.files)} static assets in [{self.outdir}]')
+
+    def write_variant(self, name, content):
+        """Write a variant to the output directory unless it exists already (the name depends on the content); returns its file name"""
+        filename = os.path.join(self.outdir, name)
+        if not os.path.exists(filename):
+            cfgstore.write_file_atomic(filename, content)
+        return filename
+
+    def remove_outdated(self):
+        """Remove the variants of previous versions of the static files from the output directory"""
+        current = set( os.path.basename(filename) for content_type, variants in self.files.values() for filename in variants.values() )
+        for name in os.listdir(self.outdir):
+            if (name not in current) and not name.startswith('.'):
+                try:
+                    os.unlink(os.path.join(self.outdir, name))
+                except OSError:
+                    pass
+
+    def url(self, name):
+        """Get the URL of the static file with the given name (Jinja global "asset_url")"""
+        return '/static/' + self.urls.get(name, name)
+
+    @staticmethod
+    def select_encoding(variants):
+        """Select the best of the available encodings that is accepted by the client"""
+        accepted = { element.value.lower(): element.qvalue for element in cherrypy.request.headers.elements('Accept-Encoding') }
+        for encoding in ENCODING_SUFFIXES:
+            if (encoding in variants) and (accepted.get(encoding, accepted.get('*', 0)) > 0):
+                return encoding
+        return 'identity'
+
+    @cherrypy.expose
+    def default(self, name):
+        """Serve a static file; hashed names are served precompressed and cached forever, others are revalidated"""
+        entry = self.files.get(name)
+        if entry is None:
+            if (os.path.basename(name) != name) or name.startswith('.'):
+                raise cherrypy.NotFound()
+            cherrypy.response.headers['Cache-Control'] = REVALIDATE_CACHE_CONTROL
+            return cherrypy.lib.static.serve_file(os.path.join(self.staticdir, name)) # unknown names raise NotFound
+        content_type, variants = entry
+        encoding = self.select_encoding(variants)
+        cherrypy.response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        if encoding != 'identity':
+            cherrypy.response.headers['Content-Encoding'] = encoding
+        return cherrypy.lib.static.serve_file(variants[encoding], content_type=content_type)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""Protection of the login against floods: throttling and password verification in a bounded process pool"""
+
+import concurrent.futures
+import concurrent.futures.process
+import logging
+import threading
+import time
+
+from . import procpool
+from . import pwdtools
+
+
+logger = logging.getLogger(__name__)
+
+
+class VerifierBusy(Exception):
+    """Raised if too many password verifications are queued already or the process pool doesn't respond"""
+
+
+class LoginThrottle():
+    """Token bucket per source address limiting the rate of login attempts"""
+
+    def __init__(self, rate=10.0, burst=5, max_sources=10000):
+        """Allow "rate" attempts per minute and source with bursts of up to "burst" attempts"""
+        self.rate = rate / 60.0 # tokens per second
+        self.burst = burst
+        self.max_sources = max_sources
+        self._buckets = dict() # source -> (tokens, timestamp of last update)
+        self._lock = threading.Lock()
+
+    def allow(self, source):
+        """Take a token for the given source; returns whether the attempt is allowed"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, timestamp = self._buckets.get(source, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - timestamp) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[source] = (tokens, now)
+            if len(self._buckets) > self.max_sources:
+                self.prune(now)
+        return allowed
+
+    def prune(self, now):
+        """Forget sources whose buckets are full again (to be called holding the lock)"""
+        self._buckets = { source: (tokens, timestamp) for source, (tokens, timestamp) in self._buckets.items()
+                          if tokens + (now - timestamp) * self.rate < self.burst }
+
+
+class PasswordVerifier():
+    """Runs password hashing and verification in a dedicated process pool with a limit on queued requests"""
+
+    def __init__(self, workers=2, queue_limit=8, timeout=30):
+        """Initialize with the given number of worker processes and maximum number of requests in progress"""
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(queue_limit)
+
+    def get_executor(self):
+        """Get the process pool (created on first use, i.e. after privileges have been dropped)"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = procpool.create_executor(self.workers)
+            return self._executor
+
+    def run(self, func, *args):
+        """Run the given function in the process pool and wait for its result; raises VerifierBusy if the queue is full,
+           the result doesn't arrive in time or the pool is broken (it is recreated on next use then)"""
+        if not self._slots.acquire(blocking=False):
+            raise VerifierBusy('Too many password verifications in progress')
+        try:
+            try:
+                executor = self.get_executor()
+                future = executor.submit(func, *args)
+            except BaseException:
+                self._slots.release()
+                raise
+            future.add_done_callback(lambda future: self._slots.release()) # the slot is kept until the task has finished, even if we stop waiting
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise VerifierBusy('Password verification timed out')
+        except concurrent.futures.process.BrokenProcessPool:
+            logger.warning('Password verification pool is broken, restarting it')
+            self.discard_executor(executor)
+            raise VerifierBusy('Password verification pool is broken')
+
+    def discard_executor(self, executor):
+        """Drop the given (broken) process pool so that a new one is created on next use"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def verify_password(self, stored_password, provided_password):
+        """Verify a stored password against one provided by user"""
+        return self.run(pwdtools.verify_password, stored_password, provided_password)
+
+    def hash_password(self, password):
+        """Hash a password for storing using the current default parameters"""
+        return self.run(pwdtools.hash_password, password)
+
+    def shutdown(self):
+        """Shut down the process pool"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
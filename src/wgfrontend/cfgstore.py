@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""Crash-safe writing of config files with group commit and compressed backups"""
+
+import datetime
+import fcntl
+import gzip
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def write_file_atomic(filename, content, mode=0o644):
+    """Write the file via a temporary file so that concurrent readers (and other worker processes) never see a partial file"""
+    fd, tmpname = tempfile.mkstemp(prefix='.', dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmpname, mode)
+        os.replace(tmpname, filename)
+    except BaseException:
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+        raise
+
+
+class FileLock():
+    """Reentrant lock shared between the threads of this process and other processes (flock on a lock file)"""
+
+    def __init__(self, filename):
+        """Initialize for the given lock file (created on first use)"""
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._fd = None
+        self._depth = 0
+
+    def acquire(self):
+        """Acquire the lock, waiting for other threads and processes holding it"""
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth > 1:
+            return
+        try:
+            if self._fd is None: # opened per process as flock locks are shared by inherited file descriptors
+                self._fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._depth -= 1
+            self._lock.release()
+            raise
+
+    def release(self):
+        """Release the lock"""
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class ConfigStore():
+    """Writes a config file atomically (temp file, fsync, rename) and keeps compressed previous versions"""
+
+    def __init__(self, filename, backupdir=None, backup_count=10, commit_window=0.0):
+        """Initialize for the given file; backups are stored in "backupdir" (none if None or backup_count is 0)"""
+        self.filename = filename
+        self.backupdir = backupdir
+        self.backup_count = backup_count
+        self.commit_window = commit_window # seconds to wait for further changes to be written in the same commit
+        self._cond = threading.Condition()
+        self._writing = False
+        self._requested = 0 # number of the last requested commit
+        self._committed = 0 # all commits up to this number are durable
+        self._inplace_logged = False
+        self.commits = 0 # number of actual writes
+
+    def fsync_dir(self, dirname):
+        """Make a rename within the given directory durable"""
+        try:
+            fd = os.open(dirname, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def write_atomic(self, content):
+        """Write the content to a temp file in the same directory, fsync it and rename it to the target;
+           a symlink is resolved so that it stays in place (see setupenv.move_to_managed_dir)"""
+        target = os.path.realpath(self.filename)
+        dirname = os.path.dirname(target)
+        try:
+            st = os.stat(target)
+        except FileNotFoundError:
+            st = None
+        fd, tmpname = tempfile.mkstemp(prefix='.' + os.path.basename(target) + '.', suffix='.tmp', dir=dirname)
+        try:
+            with os.fdopen(fd, 'w') as tmpfile:
+                os.fchmod(tmpfile.fileno(), st.st_mode & 0o7777 if st is not None else 0o640)
+                if (st is not None) and (os.getuid() == 0):
+                    os.fchown(tmpfile.fileno(), st.st_uid, st.st_gid)
+                tmpfile.write(content)
+                tmpfile.flush()
+                os.fsync(tmpfile.fileno())
+            os.replace(tmpname, target)
+        except BaseException:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            raise
+        self.fsync_dir(dirname)
+
+    def write_inplace(self, content):
+        """Overwrite the file in place (used if no temp file can be created in its directory)"""
+        with os.fdopen(os.open(self.filename, os.O_WRONLY | os.O_CREAT, 0o640), 'w') as wgfile:
+            wgfile.write(content)
+            wgfile.truncate()
+            wgfile.flush()
+            os.fsync(wgfile.fileno())
+
+    def write(self, content):
+        """Write the given content to the file after backing up the previous version"""
+        self.backup()
+        try:
+            self.write_atomic(content)
+        except PermissionError:
+            if not self._inplace_logged: # once per process start
+                backups = ' (previous versions are backed up)' if self.backupdir and self.backup_count else ''
+                logger.warning(f'No permission to create files next to [{os.path.realpath(self.filename)}], overwriting it in place, '
+                               f'which is not crash-safe{backups}; run "wgfrontend" as root once to fix the setup')
+                self._inplace_logged = True
+            self.write_inplace(content)
+        self.commits += 1
+
+    def commit(self, get_content):
+        """Write the content returned by "get_content" so that all changes made before this call are durable on return;
+           concurrent calls are batched into a single write"""
+        with self._cond:
+            self._requested += 1
+            ticket = self._requested
+            while self._writing:
+                self._cond.wait()
+            if self._committed >= ticket:
+                return # written by another thread in the meantime
+            self._writing = True
+        success = False
+        try:
+            if self.commit_window > 0:
+                time.sleep(self.commit_window) # give further changes the chance to be part of this commit
+            with self._cond:
+                target = self._requested
+            self.write(get_content())
+            success = True
+        finally:
+            with self._cond:
+                self._writing = False
+                if success:
+                    self._committed = max(self._committed, target)
+                self._cond.notify_all()
+
+    def get_backup_prefix(self):
+        """Get the file name prefix of the backups"""
+        return os.path.basename(self.filename) + '.'
+
+    def backup(self):
+        """Store the current version of the file compressed in the backup directory and remove old backups"""
+        if not self.backupdir or (self.backup_count <= 0):
+            return
+        try:
+            with open(self.filename, 'r') as wgfile: # read from disk as the file may have been changed externally
+                content = wgfile.read()
+        except FileNotFoundError:
+            return
+        try:
+            os.makedirs(self.backupdir, mode=0o700, exist_ok=True)
+            timestamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f')
+            backupname = os.path.join(self.backupdir, f'{self.get_backup_prefix()}{timestamp}.gz')
+            with os.fdopen(os.open(backupname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as backupfile:
+                with gzip.GzipFile(fileobj=backupfile, mode='wb', mtime=0) as gzfile:
+                    gzfile.write(content.encode('utf-8'))
+            for name in self.list_backups()[self.backup_count:]:
+                os.unlink(os.path.join(self.backupdir, name))
+        except OSError as e:
+            logger.warning(f'Could not back up [{self.filename}] to [{self.backupdir}]: [{e}]')
+
+    def list_backups(self):
+        """Get the file names of the available backups, newest first"""
+        if not self.backupdir or not os.path.isdir(self.backupdir):
+            return []
+        prefix = self.get_backup_prefix()
+        names = [ name for name in os.listdir(self.backupdir) if name.startswith(prefix) and name.endswith('.gz') ]
+        return sorted(names, reverse=True)
+
+    def read_backup(self, name):
+        """Get the content of the given backup"""
+        if os.path.basename(name) != name:
+            raise ValueError('Invalid backup name')
+        with gzip.open(os.path.join(self.backupdir, name), 'rt', encoding='utf-8') as gzfile:
+            return gzfile.read()
+
+    def restore_backup(self, name):
+        """Replace the file with the content of the given backup (the current version is backed up as well)"""
+        content = self.read_backup(name)
+        self.commit(lambda: content)
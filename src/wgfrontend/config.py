@@ -3,8 +3,10 @@
 import configparser
 import logging
 import os
+import re
 import textwrap
 
+from . import cfgstore
 from . import pwdtools
 
 
@@ -16,6 +18,10 @@ config_filename = '/etc/wgfrontend/wgfrontend.conf'
 class Configuration():
     """Class for reading/writing the configuration file"""
     _config = None
+    _users = None
+    _filelock = None # serializes changes of the config file between threads and worker processes
+    _api_tokens = None
+    _interface_sections = None
 
     def exists(self):
         """Checks whether the config file exists"""
@@ -29,6 +35,8 @@ class Configuration():
             cfg.read(self.filename)
             self._config = dict(cfg['general'])
             self._users = dict(cfg['users'])
+            self._api_tokens = dict(cfg['api_tokens']) if cfg.has_section('api_tokens') else dict()
+            self._interface_sections = [ (section, dict(cfg[section])) for section in cfg.sections() if section.startswith('interface:') ]
         except Exception as e:
             logger.warning('Config file [{0}] could not be read [{1}], using defaults'.format(self.filename, str(e)))
             self._config = dict()
@@ -55,10 +63,35 @@ class Configuration():
             # wg_configfile = /etc/wireguard/wg_rw.conf
             wg_configfile = {wg_configfile}
     
-            # The command to be executed when the WireGuard config has changed
+            # How to apply changes of the WireGuard config: "live" pushes only the changed peers to the
+            # running interface using the wg tool, "command" executes on_change_command
+            # apply_method = command
+            apply_method = live
+    
+            # The command line for invoking the wg tool (used for applying changes live)
+            # wg_command = sudo --non-interactive wg
+    
+            # Seconds between queries of the peer status (handshakes, transfer) from the interface (0 to disable)
+            # status_interval = 10
+    
+            # Backend for generating keys: "auto" ("cryptography" if installed, "wg" otherwise), "cryptography", "python" (built-in, not constant-time) or "wg" (WireGuard tools)
+            # key_backend = auto
+    
+            # The command to be executed when the WireGuard config has changed (if apply_method is "command")
             # on_change_command = 
             on_change_command = "sudo --non-interactive wg-quick down {wg_configfile}; sudo --non-interactive wg-quick up {wg_configfile}"
     
+            # Seconds to wait for further changes before running on_change_command (changes are applied in the background)
+            # apply_delay = 1.0
+    
+            # Addresses of the WireGuard network that shall not be assigned to clients
+            # (comma-separated list of addresses, networks and ranges like 192.168.0.20-192.168.0.25)
+            # reserved_addresses = 
+    
+            # Number of login attempts per minute and address, and attempts allowed in quick succession
+            # login_rate = 10
+            # login_burst = 5
+    
             # The interface the web server shall bind to
             # socket_host = 0.0.0.0
             socket_host = {socket_host}
@@ -67,9 +100,28 @@ class Configuration():
             # socket_port = 8080
             socket_port = {socket_port}
             
+            # Number of web server processes sharing the port (use more than one to make use of several CPU cores);
+            # sessions are then stored in /var/lib/wgfrontend/sessions (session_storage = file)
+            # workers = 1
+            # session_storage = ram
+
             # The system user to be used for the frontend
             # user = wgfrontend
             user = {user}
+    
+            # Reload templates when they are changed (otherwise they are precompiled at startup)
+            # debug = false
+    
+            # Log requests taking longer than slow_request_threshold seconds with the durations of their phases;
+            # profile_sample_rate is the share of requests for which cProfile data is stored in /var/lib/wgfrontend/profiles
+            # profiling = false
+            # slow_request_threshold = 1.0
+            # profile_sample_rate = 0.0
+
+            # Additional WireGuard interfaces can be managed by adding sections like the following; settings not
+            # given there are taken from this section except for on_change_command and reserved_addresses
+            # [interface:staff]
+            # wg_configfile = /etc/wireguard/wg_staff.conf
             
             [users]
             {username} = {password}
@@ -81,6 +133,40 @@ class Configuration():
         except OSError as e:
             logger.error('Could not write config file [{0}], [{1}]'.format(self.filename, str(e)))
 
+    def update_user_password(self, username, password_hash):
+        """Replaces the stored password hash of the given user in the config file (e.g. after upgrading the hash)"""
+        if self._filelock is None:
+            Configuration._filelock = cfgstore.FileLock(os.path.join(self.libdir, os.path.basename(self.filename) + '.lock'))
+        try:
+            with self._filelock:
+                self.replace_user_password(username, password_hash)
+        except KeyError:
+            logger.warning('User [{0}] not found in config file [{1}]'.format(username, self.filename))
+            return False
+        except OSError as e:
+            logger.warning('Could not update password of user [{0}] in config file [{1}], [{2}]'.format(username, self.filename, str(e)))
+            return False
+        self._users[username] = password_hash
+        return True
+
+    def replace_user_password(self, username, password_hash):
+        """Rewrite the config file (via a temp file and rename) with the password hash of the user replaced; raises KeyError if the user doesn't exist"""
+        with open(self.filename, 'r') as config_file:
+            lines = config_file.readlines()
+        section = None
+        for i, line in enumerate(lines):
+            match = re.match(r'\s*\[([^\]]+)\]', line)
+            if match:
+                section = match.group(1).strip()
+                continue
+            key, sep, value = line.partition('=')
+            if (section == 'users') and sep and (key.strip().lower() == username.lower()):
+                lines[i] = f'{key.rstrip()} = {password_hash}\n'
+                break
+        else:
+            raise KeyError(username)
+        cfgstore.ConfigStore(self.filename, backup_count=0).write(''.join(lines)) # falls back to writing in place if needed
+
     @property
     def filename(self):
         """Return the name of the config file (incl. path)"""
@@ -100,6 +186,24 @@ class Configuration():
             self.read_config()
         return self._users
 
+    @property
+    def api_tokens(self):
+        """Return the dictionary of API token names and hashes"""
+        if self._api_tokens is None:
+            self.read_config()
+        return self._api_tokens or dict()
+
+    @property
+    def interfaces(self):
+        """The configurations of the managed WireGuard interfaces: the one of the "general" section first,
+           followed by the ones of the "interface:<label>" sections"""
+        if self._interface_sections is None:
+            self.read_config()
+        for section, settings in self._interface_sections or []:
+            if not settings.get('wg_configfile', '').strip(): # the default would be the config file of the "general" section
+                raise ValueError(f'Section [{section}] of config file [{self.filename}] lacks the setting "wg_configfile"')
+        return [InterfaceConfiguration(self, dict())] + [ InterfaceConfiguration(self, settings, inherit=False) for section, settings in self._interface_sections or [] ]
+
     @property
     def wg_configfile(self):
         """The filename incl. path of the config file for the WireGuard interface"""
@@ -134,6 +238,112 @@ class Configuration():
                 cmd = cmd[1:-1]
         return cmd
 
+    @property
+    def debug(self):
+        """Whether to run in debug mode (templates are reloaded on changes)"""
+        return self.config.get('debug', 'false').strip().lower() in ['1', 'yes', 'true', 'on']
+
+    @property
+    def apply_method(self):
+        """How to apply config changes ("command" or "live")"""
+        return self.config.get('apply_method', 'command').strip().lower()
+
+    @property
+    def wg_command(self):
+        """The command line for invoking the wg tool"""
+        return self.config.get('wg_command', 'sudo --non-interactive wg')
+
+    @property
+    def key_backend(self):
+        """Backend for generating keys and deriving public keys"""
+        return self.config.get('key_backend', 'auto').strip().lower()
+
+    @property
+    def apply_delay(self):
+        """Seconds to wait for further changes before applying them"""
+        return float(self.config.get('apply_delay', 1.0))
+
+    @property
+    def status_interval(self):
+        """Seconds between queries of the status of the peers from the interface (0: disabled)"""
+        return float(self.config.get('status_interval', 10.0))
+
+    @property
+    def reserved_addresses(self):
+        """Addresses of the WireGuard network that shall not be assigned to clients"""
+        return self.config.get('reserved_addresses', '')
+
+    @property
+    def qrcode_cache_size(self):
+        """Maximum number of rendered QR codes to keep in memory"""
+        return int(self.config.get('qrcode_cache_size', 256))
+
+    @property
+    def process_pool_size(self):
+        """Number of processes for CPU-bound tasks like rendering QR codes (0: number of CPUs)"""
+        return int(self.config.get('process_pool_size', 0))
+
+    @property
+    def workers(self):
+        """Number of web server processes sharing the listening socket (1: single process)"""
+        return max(int(self.config.get('workers', 1)), 1)
+
+    @property
+    def session_storage(self):
+        """Where sessions are stored: "ram" or "file" (in libdir; needed for multiple workers)"""
+        default = 'file' if self.workers > 1 else 'ram'
+        return self.config.get('session_storage', default).strip().lower()
+
+    @property
+    def backup_count(self):
+        """Number of compressed previous versions of the WireGuard config file to keep"""
+        return int(self.config.get('backup_count', 10))
+
+    @property
+    def commit_window(self):
+        """Seconds to wait for further changes to be written together with a change"""
+        return float(self.config.get('commit_window', 0.0))
+
+    @property
+    def login_rate(self):
+        """Number of login attempts per minute allowed from a single address"""
+        return float(self.config.get('login_rate', 10.0))
+
+    @property
+    def login_burst(self):
+        """Number of login attempts allowed from a single address in quick succession"""
+        return int(self.config.get('login_burst', 5))
+
+    @property
+    def login_workers(self):
+        """Number of processes for verifying passwords"""
+        return int(self.config.get('login_workers', 2))
+
+    @property
+    def login_queue_limit(self):
+        """Maximum number of password verifications in progress; further login attempts are rejected"""
+        return int(self.config.get('login_queue_limit', 8))
+
+    @property
+    def page_size(self):
+        """Number of clients shown per page in the client list"""
+        return int(self.config.get('page_size', 50))
+
+    @property
+    def profiling(self):
+        """Whether to time the phases of requests and log slow requests"""
+        return self.config.get('profiling', 'false').strip().lower() in ['1', 'yes', 'true', 'on']
+
+    @property
+    def slow_request_threshold(self):
+        """Seconds after which a request or background task is logged with the durations of its phases"""
+        return float(self.config.get('slow_request_threshold', 1.0))
+
+    @property
+    def profile_sample_rate(self):
+        """Share of requests to profile using cProfile if profiling is on (dumps are stored in libdir)"""
+        return float(self.config.get('profile_sample_rate', 0.0))
+
     @property
     def socket_host(self):
         """The interface to bind to"""
@@ -148,3 +358,18 @@ class Configuration():
     def user(self):
         """The configured name for the wgfrontend system user"""
         return self.config.get('user', 'wgfrontend')
+
+
+class InterfaceConfiguration(Configuration):
+    """Configuration of a single WireGuard interface; settings not given for the interface are taken from the "general" section"""
+    INTERFACE_SETTINGS = ['wg_configfile', 'on_change_command', 'reserved_addresses'] # not inherited by additional interfaces
+
+    def __init__(self, parent, settings, inherit=True):
+        """Initialize with the configuration of the "general" section and the settings specific to this interface"""
+        self.parent = parent
+        general = { key: value for key, value in parent.config.items() if inherit or (key not in self.INTERFACE_SETTINGS) }
+        self._config = dict(general, **settings)
+
+    @property
+    def libdir(self):
+        return self.parent.libdir
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""Detection of changes of a file using inotify with a stat-based fallback"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+
+def get_file_signature(filename):
+    """Get a cheap signature of a file on disk (None if it does not exist)"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class FileWatcher():
+    """Detects whether a file has been changed since the last call of update()"""
+
+    def __init__(self, filename, use_inotify=True):
+        """Initialize the watcher for the given file"""
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._signature = None
+        self._fd = None
+        self._wd = None
+        self._watch_dir = False # whether the directory is watched (otherwise the file itself)
+        self._pending = True # whether events were seen that have not been verified yet
+        if use_inotify:
+            self._init_inotify()
+
+    def _init_inotify(self):
+        """Set up inotify if available on this system"""
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            return
+        try:
+            self._libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logger.debug(f'inotify not available: [{e}]')
+            return
+        if fd < 0:
+            logger.debug('inotify_init1 failed')
+            return
+        self._fd = fd
+        # Watching the directory also catches the file being replaced; fall back to the file if the directory isn't readable
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        self._wd = self._add_watch(dirname, IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE)
+        if self._wd is not None:
+            self._watch_dir = True
+        elif not self._arm_file_watch():
+            logger.info(f'Could not watch [{self.filename}] using inotify, using stat-based change detection')
+            os.close(self._fd)
+            self._fd = None
+
+    def _add_watch(self, path, mask):
+        """Add an inotify watch; returns the watch descriptor or None"""
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        return wd if wd >= 0 else None
+
+    def _arm_file_watch(self):
+        """Watch the file itself (needed again after it has been replaced)"""
+        self._wd = self._add_watch(self.filename, IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF)
+        return self._wd is not None
+
+    def _read_events(self):
+        """Read all queued inotify events; returns whether any of them concerns the watched file"""
+        relevant = False
+        rearm = False
+        basename = os.fsencode(os.path.basename(self.filename))
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    relevant = True
+                elif self._watch_dir:
+                    relevant = relevant or (name == basename)
+                else:
+                    relevant = True
+                    if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                        rearm = True
+        if rearm:
+            self._arm_file_watch()
+        return relevant
+
+    @property
+    def uses_inotify(self):
+        """Whether changes are detected using inotify"""
+        return self._fd is not None
+
+    def update(self):
+        """Remember the current state of the file as known (e.g. after reading or writing it)"""
+        with self._lock:
+            if self._fd is not None:
+                self._read_events() # discard events caused by ourselves
+                if not self._watch_dir and (self._wd is None):
+                    self._arm_file_watch()
+            self._pending = False
+            self._signature = get_file_signature(self.filename)
+
+    def check(self):
+        """Check whether the file has been changed since the last update(); cheap if nothing happened"""
+        with self._lock:
+            if self._fd is not None:
+                if self._read_events():
+                    self._pending = True
+                if not self._pending:
+                    return False # no event, not even a stat() is needed
+            signature = get_file_signature(self.filename)
+            if signature == self._signature:
+                self._pending = False
+                return False
+            return True
+
+    def close(self):
+        """Release the inotify file descriptor"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""Registry of the managed WireGuard interfaces, each with its own config data, apply pipeline and status poller"""
+
+import logging
+import os
+import subprocess
+
+from . import applysched
+from . import metrics
+from . import profiling
+from . import wgapply
+from . import wgcfg
+from . import wgstatus
+
+
+logger = logging.getLogger(__name__)
+
+
+class Interface():
+    """A managed WireGuard interface; changes are applied on a background thread of its own so that a slow apply
+       doesn't block other interfaces"""
+
+    def __init__(self, cfg, shared=False, statedir=None, poll_status=True):
+        """Initialize for the given interface configuration; "shared" is set if other processes change the config file as well;
+           the status is polled by one process only ("poll_status") and shared with the others via a file in "statedir" """
+        self.cfg = cfg
+        self.name = cfg.wg_interface
+        snapshot_file = os.path.join(statedir, f'status-{self.name}.json') if statedir is not None else None
+        self.status_poller = wgstatus.StatusPoller(self.name, cfg.wg_command, interval=cfg.status_interval, snapshot_file=snapshot_file, active=poll_status)
+        self.live_applier = wgapply.LiveApplier(self.name, cfg.wg_command)
+        self.apply_scheduler = applysched.ApplyScheduler(self.apply_changes, delay=cfg.apply_delay, name=f'apply-{self.name}')
+        self.wg = wgcfg.WGCfg(cfg.wg_configfile, cfg.libdir, self.apply_scheduler.trigger, reserved_addresses=cfg.reserved_addresses, qrcode_cache_size=cfg.qrcode_cache_size,
+                              backup_count=cfg.backup_count, commit_window=cfg.commit_window, shared=shared)
+
+    def apply_changes(self):
+        """Apply config changes to the interface or run the on_change_command (called by the apply scheduler)"""
+        method = 'live' if self.cfg.apply_method == 'live' else 'command'
+        with metrics.timer('wgfrontend_apply_duration_seconds', interface=self.name, method=method), profiling.task('apply'):
+            success = self.run_apply(method)
+        metrics.inc('wgfrontend_apply_total', interface=self.name, method=method, result='success' if success else 'failure')
+        return success
+
+    def run_apply(self, method):
+        """Apply config changes using the given method"""
+        if method == 'live':
+            with profiling.phase('wg'):
+                return self.live_applier.apply(self.wg)
+        on_change_command = self.cfg.on_change_command
+        if (on_change_command is not None) and (len(on_change_command) > 0):
+            with profiling.phase('on_change_command'):
+                returncode = subprocess.call(on_change_command, shell=True)
+            if returncode != 0:
+                logger.error(f'Error calling on_change_command of interface [{self.name}]')
+                return False
+        return True
+
+    def start(self):
+        """Start the background activities"""
+        self.status_poller.start()
+
+    def stop(self):
+        """Stop the background activities; pending changes are applied before"""
+        self.apply_scheduler.stop()
+        self.status_poller.stop()
+
+
+class InterfaceRegistry():
+    """The managed interfaces by name, in the order of the configuration"""
+
+    def __init__(self, cfgs, shared=False, statedir=None, poll_status=True):
+        """Create the interfaces for the given interface configurations (see Interface for the other parameters)"""
+        self._interfaces = dict()
+        for cfg in cfgs:
+            if cfg.wg_interface in self._interfaces:
+                raise ValueError(f'Interface [{cfg.wg_interface}] is configured more than once')
+            self._interfaces[cfg.wg_interface] = Interface(cfg, shared, statedir, poll_status)
+
+    def __iter__(self):
+        return iter(self._interfaces.values())
+
+    def __len__(self):
+        return len(self._interfaces)
+
+    @property
+    def names(self):
+        """The names of the interfaces"""
+        return list(self._interfaces)
+
+    @property
+    def default(self):
+        """The first interface"""
+        return next(iter(self._interfaces.values()))
+
+    def get(self, name=None):
+        """Get the interface with the given name (the default one if None); raises KeyError if there is none"""
+        if name is None:
+            return self.default
+        return self._interfaces[name]
+
+    def reload_if_changed(self):
+        """Re-read the config files that have been changed externally"""
+        for interface in self:
+            interface.wg.reload_if_changed()
+
+    def start(self):
+        """Start the background activities of all interfaces"""
+        for interface in self:
+            interface.start()
+
+    def stop(self):
+        """Stop the background activities of all interfaces"""
+        for interface in self:
+            interface.stop()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""Simple thread-safe cache with least-recently-used eviction"""
+
+import collections
+import threading
+
+
+class LRUCache():
+    """Dictionary-like cache with a maximum number of entries"""
+
+    def __init__(self, maxsize=128):
+        """Initialize the cache for at most "maxsize" entries"""
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Get the value stored for the given key and mark it as recently used"""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store a value for the given key, evicting the least recently used entry if full"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def cache_info(self):
+        """Get statistics on the cache"""
+        return { 'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize }
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""Collection of internal metrics and rendering in the Prometheus text format;
+   values are recorded in per-thread shards so that recording doesn't need any lock;
+   worker processes share their values via files so that each of them renders the sum"""
+
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from . import cfgstore
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help text, buckets)
+DEFINITIONS = {
+    'wgfrontend_http_requests_total': ('counter', 'Number of HTTP requests by handler and status code', None),
+    'wgfrontend_http_request_duration_seconds': ('histogram', 'Duration of HTTP requests by handler', DEFAULT_BUCKETS),
+    'wgfrontend_config_write_duration_seconds': ('histogram', 'Duration of writing the WireGuard config file', DEFAULT_BUCKETS),
+    'wgfrontend_qrcode_render_duration_seconds': ('histogram', 'Duration of rendering a QR code on request', DEFAULT_BUCKETS),
+    'wgfrontend_apply_duration_seconds': ('histogram', 'Duration of applying config changes by method', DEFAULT_BUCKETS),
+    'wgfrontend_apply_total': ('counter', 'Number of attempts to apply config changes by method and result', None),
+    'wgfrontend_key_operations_total': ('counter', 'Number of key operations by backend and operation', None),
+    'wgfrontend_key_subprocesses_total': ('counter', 'Number of wg tool processes started for key operations', None),
+    'wgfrontend_logins_total': ('counter', 'Number of login attempts by result', None),
+}
+
+_local = threading.local()
+_shards = [] # (thread, shard) for each thread that has recorded values
+_retired = dict() # values of threads that have ended
+_lock = threading.Lock() # only needed when a thread records its first value and when rendering
+_gauges = [] # (name, help text, function returning a value or a list of (labels, value))
+_sharing = None # (directory, file name of this process) if the values are shared with other processes
+
+
+def _get_shard():
+    """Get the dictionary the current thread records its values in"""
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = dict()
+        with _lock:
+            _shards.append((threading.current_thread(), shard))
+        _local.shard = shard
+        return shard
+
+def _get_key(name, labels):
+    """Get the key for the given metric and labels"""
+    return (name, tuple(sorted(labels.items())))
+
+def inc(name, value=1, **labels):
+    """Increment the given counter"""
+    shard = _get_shard()
+    key = _get_key(name, labels)
+    shard[key] = shard.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """Record an observation of the given histogram"""
+    shard = _get_shard()
+    key = _get_key(name, labels)
+    entry = shard.get(key)
+    buckets = DEFINITIONS[name][2]
+    if entry is None:
+        entry = shard[key] = [0] * (len(buckets) + 3) # count per bucket incl. +Inf, sum, count
+    entry[bisect.bisect_left(buckets, value)] += 1
+    entry[-2] += value
+    entry[-1] += 1
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Context manager recording the duration of the enclosed code in the given histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def register_gauge(name, help, func):
+    """Register a gauge whose value is determined by calling "func" when rendering;
+       "func" returns a number or a list of (labels dictionary, number) tuples"""
+    with _lock:
+        _gauges.append((name, help, func))
+
+def unregister_gauges(prefix=''):
+    """Remove the gauges whose names start with the given prefix"""
+    with _lock:
+        _gauges[:] = [ gauge for gauge in _gauges if not gauge[0].startswith(prefix) ]
+
+def merge(target, source):
+    """Add the values of one shard to another"""
+    for key, value in source.items():
+        if isinstance(value, list):
+            entry = target.setdefault(key, [0] * len(value))
+            for i, item in enumerate(value):
+                entry[i] += item
+        else:
+            target[key] = target.get(key, 0) + value
+
+def collect():
+    """Get the sum of the values of all threads"""
+    with _lock:
+        alive = []
+        for thread, shard in _shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                merge(_retired, shard)
+        _shards[:] = alive
+        result = dict()
+        merge(result, _retired)
+        for thread, shard in alive:
+            merge(result, dict(shard)) # copy as the owning thread may add keys meanwhile
+    return result
+
+def share_values(directory, name):
+    """Share the values with the other worker processes writing files to the given directory; "name" identifies this process"""
+    global _sharing
+    _sharing = (directory, f'metrics-{name}.json')
+
+def write_shared():
+    """Write the values of this process for the other processes (called periodically and when rendering)"""
+    if _sharing is None:
+        return
+    directory, filename = _sharing
+    values = [ [name, labels, value] for (name, labels), value in collect().items() ]
+    try:
+        cfgstore.write_file_atomic(os.path.join(directory, filename), json.dumps(values).encode('utf-8'), mode=0o600)
+    except OSError as e:
+        logger.warning(f'Could not write metrics for other processes: [{e}]')
+
+def read_shared():
+    """Get the sum of the values last written by all processes"""
+    result = dict()
+    directory = _sharing[0]
+    try:
+        filenames = os.listdir(directory)
+    except OSError:
+        return result
+    for filename in filenames:
+        if not (filename.startswith('metrics-') and filename.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(directory, filename), 'r') as f:
+                values = json.load(f)
+        except (OSError, ValueError): # process gone meanwhile
+            continue
+        merge(result, { (name, tuple( tuple(label) for label in labels )): value for name, labels, value in values })
+    return result
+
+def format_labels(labels, extra=()):
+    """Format the labels of a sample"""
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items) + '}'
+
+def format_value(value):
+    """Format a sample value"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def render():
+    """Render all metrics in the Prometheus text exposition format"""
+    if _sharing is not None:
+        # Take the values of this process from its file as well so that the sums never decrease, whichever process renders them
+        write_shared()
+        values = read_shared()
+    else:
+        values = collect()
+    lines = []
+    for name, (kind, help, buckets) in DEFINITIONS.items():
+        samples = sorted((key[1], value) for key, value in values.items() if key[0] == name)
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            if kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], value[:-2]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(value[-2])}')
+                lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+            else:
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+    with _lock:
+        gauges = list(_gauges)
+    for name, help, func in gauges:
+        try:
+            result = func()
+        except Exception as e:
+            logger.warning(f'Could not determine value of gauge [{name}]: [{e}]')
+            continue
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} gauge')
+        if isinstance(result, list):
+            for labels, value in result:
+                lines.append(f'{name}{format_labels(sorted(labels.items()))} {format_value(value)}')
+        else:
+            lines.append(f'{name} {format_value(result)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""Pre-fork mode: several worker processes accepting connections on one listening socket;
+   the socket is handed over like with systemd socket activation, which CherryPy supports"""
+
+import logging
+import os
+import signal
+import socket
+import time
+
+
+logger = logging.getLogger(__name__)
+
+LISTEN_FD = 3 # file descriptor of the listening socket in the workers (as defined for systemd socket activation)
+MIN_LIFETIME = 5.0 # workers exiting earlier are restarted with a delay so that a failing worker doesn't cause a busy loop
+
+
+def create_listening_socket(host, port, backlog=128):
+    """Create a TCP socket listening on the given IPv4 address and port with the file descriptor LISTEN_FD"""
+    addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+    addresses = [ address for address in addresses if address[0] == socket.AF_INET ]
+    if not addresses:
+        # CherryPy takes over an inherited listening socket as IPv4 socket, which garbles the addresses of IPv6 clients
+        raise ValueError(f'The web server host [{host}] is not an IPv4 address; IPv6 is only supported with a single worker process (workers = 1)')
+    family, type, proto, canonname, sockaddr = addresses[0]
+    sock = socket.socket(family, type, proto)
+    if sock.fileno() != LISTEN_FD:
+        try:
+            os.fstat(LISTEN_FD)
+        except OSError: # not in use
+            os.dup2(sock.fileno(), LISTEN_FD)
+            sock.close()
+            sock = socket.socket(family, type, proto, LISTEN_FD)
+        else:
+            sock.close()
+            raise RuntimeError(f'File descriptor {LISTEN_FD} is needed for the listening socket but already in use')
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(sockaddr)
+    sock.listen(backlog)
+    return sock
+
+
+class Supervisor():
+    """Starts the worker processes, restarts them if they die and stops them on SIGTERM/SIGINT"""
+
+    def __init__(self, count, sock, worker_func):
+        """Initialize for "count" workers running "worker_func" (which serves requests on the inherited socket and gets the worker index)"""
+        self.count = count
+        self.sock = sock
+        self.worker_func = worker_func
+        self.workers = dict() # pid -> (index of the worker, start time)
+        self.stopping = False
+
+    def spawn(self, index):
+        """Start the worker process with the given index (a restarted worker keeps the index of the one it replaces)"""
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                os.environ['LISTEN_PID'] = str(os.getpid())
+                os.environ['LISTEN_FDS'] = '1'
+                self.worker_func(index)
+                code = 0
+            except BaseException:
+                logger.exception('Worker process failed')
+            finally:
+                os._exit(code)
+        self.workers[pid] = (index, time.monotonic())
+        logger.info(f'Started worker process [{pid}] with index [{index}]')
+
+    def handle_signal(self, signum, frame):
+        """Stop all workers"""
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """Run the workers until a stop is requested and all of them have exited"""
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        for index in range(self.count):
+            self.spawn(index)
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker = self.workers.pop(pid, None)
+            if (worker is None) or self.stopping:
+                continue
+            index, started = worker
+            logger.warning(f'Worker process [{pid}] exited with status [{status}], restarting it')
+            if time.monotonic() - started < MIN_LIFETIME:
+                time.sleep(MIN_LIFETIME)
+            if not self.stopping:
+                self.spawn(index)
+        self.sock.close()
+
+
+def run(count, host, port, worker_func):
+    """Listen on the given address and serve requests by "count" worker processes running "worker_func" (called with the worker index)"""
+    sock = create_listening_socket(host, port)
+    logger.info(f'Listening on [{host}:{port}] with {count} worker processes')
+    Supervisor(count, sock, worker_func).run()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""Shared pool of worker processes for CPU-bound tasks"""
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_lock = threading.Lock()
+max_workers = None # number of worker processes (None: number of CPUs)
+
+
+def create_executor(max_workers):
+    """Create a process pool executor; its worker processes are started by a single-threaded fork server
+       as forking the multithreaded web server may deadlock on locks held by other threads"""
+    if sys.version_info < (3, 7): # no choice of the start method for process pools yet
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        mp_context = multiprocessing.get_context('forkserver')
+    except ValueError: # not available on this platform
+        mp_context = multiprocessing.get_context('spawn')
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+
+def get_executor():
+    """Get the shared process pool executor (created on first use)"""
+    global _executor
+    with _lock:
+        if _executor is None:
+            workers = max_workers or os.cpu_count() or 1
+            logger.debug(f'Starting process pool with {workers} worker(s)')
+            _executor = create_executor(workers)
+        return _executor
+
+def map_tasks(func, iterable, chunksize=1):
+    """Apply the given (picklable) function to all items in the process pool; results are returned in order"""
+    return get_executor().map(func, iterable, chunksize=chunksize)
+
+def shutdown():
+    """Shut down the shared process pool"""
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
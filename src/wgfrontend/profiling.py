@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""Timing of the phases of requests, logging of slow requests and sampled cProfile dumps"""
+
+import cherrypy
+import contextlib
+import cProfile
+import datetime
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local() # profile of the request handled by the current thread
+task_threshold = None # background tasks taking at least this many seconds are logged (None: tasks are not timed)
+
+
+class RequestProfile():
+    """Timings of the phases of a single request or task"""
+
+    def __init__(self, name):
+        """Start timing the request or task with the given name"""
+        self.name = name
+        self.start = time.perf_counter()
+        self.phases = dict() # phase name -> accumulated seconds
+        self.accounted = 0.0 # seconds spent in top-level phases
+        self.depth = 0
+        self.profiler = None # cProfile.Profile if the request is sampled
+
+    def add(self, name, duration, toplevel):
+        """Add the duration of a phase"""
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+        if toplevel:
+            self.accounted += duration
+
+    def format(self, total):
+        """Get a description of the phases for logging"""
+        items = [ f'{name}={duration * 1000:.1f}ms' for name, duration in sorted(self.phases.items(), key=lambda item: -item[1]) ]
+        items.append(f'other={max(total - self.accounted, 0) * 1000:.1f}ms')
+        return ', '.join(items)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Context manager timing the enclosed code as a phase of the current request (no-op if profiling is off)"""
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        yield
+        return
+    profile.depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.depth -= 1
+        profile.add(name, time.perf_counter() - start, profile.depth == 0)
+
+@contextlib.contextmanager
+def task(name):
+    """Context manager timing a background task; phases within are recorded and the task is logged if slow"""
+    if getattr(_local, 'profile', None) is not None: # nested in a request or task
+        with phase(name):
+            yield
+        return
+    if task_threshold is None:
+        yield
+        return
+    profile = _local.profile = RequestProfile(name)
+    try:
+        yield
+    finally:
+        _local.profile = None
+        total = time.perf_counter() - profile.start
+        if total >= task_threshold:
+            logger.warning(f'Slow task [{name}] took {total * 1000:.1f}ms: {profile.format(total)}')
+
+
+class ProfilingTool(cherrypy.Tool):
+    """Tool recording the phases of each request, logging slow requests and dumping cProfile data of sampled requests"""
+
+    def __init__(self):
+        """Initialize the tool"""
+        cherrypy.Tool.__init__(self, 'on_start_resource', self.start_request, priority=10)
+
+    def _setup(self):
+        """Hook into the request (called by CherryPy)"""
+        cherrypy.Tool._setup(self)
+        conf = self._merged_args()
+        conf.pop('priority', None)
+        cherrypy.request.hooks.attach('on_end_request', self.end_request, **conf)
+
+    def start_request(self, threshold=1.0, sample_rate=0.0, dumpdir=None, max_dumps=100):
+        """Start timing the request and, if sampled, profiling it"""
+        name = getattr(getattr(cherrypy.request.handler, 'callable', None), '__qualname__', cherrypy.request.path_info)
+        profile = _local.profile = RequestProfile(name)
+        if dumpdir and (sample_rate > 0) and (random.random() < sample_rate):
+            profile.profiler = cProfile.Profile()
+            profile.profiler.enable()
+        cherrypy.request.profile = profile
+
+    def end_request(self, threshold=1.0, sample_rate=0.0, dumpdir=None, max_dumps=100):
+        """Log the request if it was slow and store the profiling data if sampled"""
+        profile = getattr(cherrypy.request, 'profile', None)
+        _local.profile = None
+        if profile is None:
+            return
+        total = time.perf_counter() - profile.start
+        if profile.profiler is not None:
+            profile.profiler.disable()
+            self.dump(profile, dumpdir, max_dumps)
+        if total >= threshold:
+            logger.warning(f'Slow request [{cherrypy.request.request_line}] handled by [{profile.name}] '
+                           f'took {total * 1000:.1f}ms: {profile.format(total)}')
+
+    @staticmethod
+    def dump(profile, dumpdir, max_dumps):
+        """Write the profiling data to the dump directory and remove old dumps"""
+        try:
+            os.makedirs(dumpdir, mode=0o750, exist_ok=True)
+            timestamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f')
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', profile.name)
+            profile.profiler.dump_stats(os.path.join(dumpdir, f'{timestamp}-{name}.pstats'))
+            dumps = sorted(name for name in os.listdir(dumpdir) if name.endswith('.pstats'))
+            for name in dumps[:-max_dumps]:
+                os.unlink(os.path.join(dumpdir, name))
+        except OSError as e:
+            logger.warning(f'Could not store profiling data in [{dumpdir}]: [{e}]')
+
+cherrypy.tools.profiling = ProfilingTool()
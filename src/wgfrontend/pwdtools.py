@@ -3,23 +3,43 @@
 
 # Thx to https://www.vitoshacademy.com/hashing-passwords-in-python/
 
-import hashlib, binascii, os
+import hashlib, hmac, binascii, os
 
 
-def hash_password(password):
+DEFAULT_ALGORITHM = 'sha512'
+DEFAULT_ITERATIONS = 210000
+LEGACY_ALGORITHM = 'sha512' # parameters of hashes without explicit parameters
+LEGACY_ITERATIONS = 100000
+
+
+def hash_password(password, algorithm=DEFAULT_ALGORITHM, iterations=DEFAULT_ITERATIONS):
     """Hash a password for storing."""
     salt = hashlib.sha256(os.urandom(60)).hexdigest().encode('ascii')
-    pwdhash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), salt, 100000)
+    pwdhash = hashlib.pbkdf2_hmac(algorithm, password.encode('utf-8'), salt, iterations)
     pwdhash = binascii.hexlify(pwdhash)
-    return (salt + pwdhash).decode('ascii')
+    return f'pbkdf2_{algorithm}${iterations}$' + (salt + pwdhash).decode('ascii')
+
+def parse_password_hash(stored_password):
+    """Split a stored password into algorithm, iterations, salt and hash"""
+    if '$' in stored_password: # "pbkdf2_<algorithm>$<iterations>$<salt><hash>"
+        scheme, iterations, stored_password = stored_password.split('$', 2)
+        algorithm = scheme.partition('_')[2]
+        iterations = int(iterations)
+    else: # legacy format without parameters
+        algorithm, iterations = LEGACY_ALGORITHM, LEGACY_ITERATIONS
+    return algorithm, iterations, stored_password[:64], stored_password[64:]
  
 def verify_password(stored_password, provided_password):
     """Verify a stored password against one provided by user"""
-    salt = stored_password[:64]
-    stored_password = stored_password[64:]
-    pwdhash = hashlib.pbkdf2_hmac('sha512', provided_password.encode('utf-8'), salt.encode('ascii'), 100000)
+    algorithm, iterations, salt, stored_password = parse_password_hash(stored_password)
+    pwdhash = hashlib.pbkdf2_hmac(algorithm, provided_password.encode('utf-8'), salt.encode('ascii'), iterations)
     pwdhash = binascii.hexlify(pwdhash).decode('ascii')
-    return pwdhash == stored_password
+    return hmac.compare_digest(pwdhash, stored_password)
+
+def needs_rehash(stored_password):
+    """Check whether a stored password uses weaker parameters than the current defaults"""
+    algorithm, iterations, salt, stored_password = parse_password_hash(stored_password)
+    return (algorithm != DEFAULT_ALGORITHM) or (iterations < DEFAULT_ITERATIONS)
 
 def hash_password_interactively():
     """Ask for a password and print it in hashed form"""
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""Readers-writer lock for sharing data between the threads of the web server"""
+
+import contextlib
+import functools
+import threading
+
+
+class RWLock():
+    """Lock allowing many concurrent readers or a single writer; waiting writers are preferred over new readers.
+       Both read and write locks are reentrant and the writer may also acquire the read lock (but not vice versa)."""
+
+    def __init__(self):
+        """Object initialization"""
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0 # number of threads holding the read lock
+        self._writer = None # identifier of the thread holding the write lock
+        self._write_depth = 0
+        self._waiting_writers = 0
+        self._local = threading.local() # read lock depth of the current thread
+
+    def acquire_read(self):
+        """Acquire the lock for reading"""
+        depth = getattr(self._local, 'depth', 0)
+        if (depth == 0) and (self._writer != threading.get_ident()):
+            with self._cond:
+                while (self._writer is not None) or self._waiting_writers:
+                    self._cond.wait()
+                self._readers += 1
+            self._local.counted = True
+        elif depth == 0:
+            self._local.counted = False # the writer reads
+        self._local.depth = depth + 1
+
+    def release_read(self):
+        """Release the lock acquired for reading"""
+        self._local.depth -= 1
+        if (self._local.depth == 0) and self._local.counted:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        """Acquire the lock for writing"""
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth += 1
+            return
+        if getattr(self._local, 'depth', 0):
+            raise RuntimeError('Upgrading a read lock to a write lock is not supported')
+        with self._cond:
+            self._waiting_writers += 1
+            while (self._writer is not None) or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self):
+        """Release the lock acquired for writing"""
+        if self._writer != threading.get_ident():
+            raise RuntimeError('Write lock released by a thread not holding it')
+        self._write_depth -= 1
+        if self._write_depth == 0:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def reading(self):
+        """Context manager holding the lock for reading"""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def writing(self):
+        """Context manager holding the lock for writing"""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def read_locked(method):
+    """Decorator for methods that need to hold the read lock of the instance's "lock" attribute"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.reading():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def write_locked(method):
+    """Decorator for methods that need to hold the write lock of the instance's "lock" attribute"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.writing():
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -73,6 +73,18 @@ def chown(username, path):
     uid = pwd.getpwnam(username).pw_uid
     os.chown(path, uid, -1)
 
+def move_to_managed_dir(username, filename):
+    """Move the given WireGuard config file into a subdirectory owned by the given user and leave a symlink in its place;
+       the user may not create files in the directory of the WireGuard configs, which is needed to replace the file atomically"""
+    if os.path.islink(filename) or not os.path.isfile(filename):
+        return False
+    managed_dir = os.path.join(os.path.dirname(filename), 'wgfrontend')
+    os.makedirs(managed_dir, mode=0o700, exist_ok=True)
+    chown(username, managed_dir)
+    os.rename(filename, os.path.join(managed_dir, os.path.basename(filename)))
+    os.symlink(os.path.join('wgfrontend', os.path.basename(filename)), filename) # relative so that wg-quick finds it under the usual name
+    return True
+
 def get_uid_gid(uid_name='nobody', gid_name='nogroup'):
     """Returns uid and gid for the given username and groupname"""
     uid = pwd.getpwnam(uid_name).pw_uid
@@ -268,6 +280,24 @@ class QueryUser():
 
         return self.get_and_validate_input(f'Please specify the IP address of the WireGuard interface incl. prefix length [{default}]:', default=default, check_function=check, expert_question=False)
 
+    def get_wg_address6(self):
+        """Query the user for the IPv6 address of the WireGuard interface incl. prefix length for dual-stack clients ("none" for IPv4 only)"""
+
+        def check(userdata):
+            if userdata.lower() == 'none':
+                return 'none'
+            try:
+                userdata = ipaddress.ip_interface(userdata)
+            except ValueError as e:
+                print('  Exception: {text}'.format(text=str(e)))
+                return None
+            if userdata.version != 6:
+                print('  Please specify an IPv6 address.')
+                return None
+            return userdata
+
+        return self.get_and_validate_input('Please specify the IPv6 address of the WireGuard interface incl. prefix length for dual-stack clients, e.g. fd00::1/64 [none]:', default='none', check_function=check, expert_question=True)
+
     def get_wg_networks(self):
         """Query the user for the network ranges that the clients shall route to the WireGuard server"""
         return self.get_and_validate_input('Please specify the network ranges that the clients shall route to the WireGuard server [192.168.0.0/16]:', default='192.168.0.0/16', expert_question=False)
@@ -307,6 +337,9 @@ def setup_environment():
         ensure_user(cfg.user)
         print(f'Ensuring ownership of config file {cfg.filename}.')
         chown(cfg.user, cfg.filename)
+        if os.path.basename(os.path.dirname(cfg.filename)) == 'wgfrontend': # dedicated directory (not e.g. /etc)
+            print(f'Ensuring ownership of directory {os.path.dirname(cfg.filename)} so that the config file can be updated crash-safe.')
+            chown(cfg.user, os.path.dirname(cfg.filename))
         if os.path.exists(cfg.libdir):
             print(f'Directory {cfg.libdir} already exists. Ok.')
         else:
@@ -333,6 +366,7 @@ def setup_environment():
             wg_listenport = qu.get_wg_listenport()
             endpoint = qu.get_endpoint()
             wg_address_obj = qu.get_wg_address(default=ip_wgif.exploded + '/' + str(network_subrange.prefixlen))
+            wg_address6_obj = qu.get_wg_address6()
             wg_networks = qu.get_wg_networks()
             # Check for ProxyARP setup
             proxy_arp_interface = None
@@ -353,7 +387,10 @@ def setup_environment():
                 endpoint += ':51820'
             wc.add_attr(None, 'ListenPort', wg_listenport, '# Endpoint = ' + endpoint, append_as_line=True)
             wc.add_attr(None, 'PrivateKey', wgexec.generate_privatekey())
-            wc.add_attr(None, 'Address', wg_address_obj.compressed, '# Networks = ' + wg_networks, append_as_line=True)
+            wg_addresses = wg_address_obj.compressed
+            if wg_address6_obj != 'none':
+                wg_addresses += ', ' + wg_address6_obj.compressed
+            wc.add_attr(None, 'Address', wg_addresses, '# Networks = ' + wg_networks, append_as_line=True)
             if proxy_arp_interface is not None:
                 wc.add_attr(None, 'PostUp', f'sysctl -w net.ipv4.conf.{proxy_arp_interface}.proxy_arp=1', append_as_line=True)
             wc.write_file()
@@ -372,9 +409,13 @@ def setup_environment():
                 else:
                     print('  Sorry, "/etc/sysctl.d" does not exist so that we could not install a config file there.')
             if qu.input_yes_no(f'Would you like to allow the system user of the web frontend to reload WireGuard on config changes (using sudo)? [Yes]:'):
+                # Rules for all managed interfaces (the one of the "general" section and those of "interface:<label>" sections)
+                wgquick_rules = ', '.join(f'/usr/bin/wg-quick down {icfg.wg_configfile}, /usr/bin/wg-quick up {icfg.wg_configfile}' for icfg in cfg.interfaces)
+                wg_rules = ', '.join(f'/usr/bin/wg set {icfg.wg_interface} *, /usr/bin/wg syncconf {icfg.wg_interface} /dev/stdin, /usr/bin/wg show {icfg.wg_interface} dump' for icfg in cfg.interfaces)
                 sudoers_content = textwrap.dedent(f'''\
                     {cfg.user}  ALL=(root) NOPASSWD: /etc/init.d/wgfrontend_interface start, /etc/init.d/wgfrontend_interface stop, /etc/init.d/wgfrontend_interface restart
-                    {cfg.user}  ALL=(root) NOPASSWD: /usr/bin/wg-quick down {cfg.wg_configfile}, /usr/bin/wg-quick up {cfg.wg_configfile}
+                    {cfg.user}  ALL=(root) NOPASSWD: {wgquick_rules}
+                    {cfg.user}  ALL=(root) NOPASSWD: {wg_rules}
                 ''')    
                 if os.path.isdir('/etc/sudoers.d'):
                     with open('/etc/sudoers.d/wgfrontend', 'w') as sudoers_file:
@@ -419,8 +460,12 @@ def setup_environment():
                         print('  Sorry, "/etc/systemd/system" does not exist so that the service file could not be installed.')
         print(f'Ensuring list permission of WireGuard config directory {os.path.dirname(cfg.wg_configfile)}.')
         os.chmod(os.path.dirname(cfg.wg_configfile), 0o711)
-        print(f'Ensuring ownership of WireGuard config file {cfg.wg_configfile}.')
-        chown(cfg.user, cfg.wg_configfile)
+        for interface_cfg in cfg.interfaces:
+            if os.path.exists(interface_cfg.wg_configfile):
+                print(f'Ensuring ownership of WireGuard config file {interface_cfg.wg_configfile}.')
+                chown(cfg.user, interface_cfg.wg_configfile)
+                if move_to_managed_dir(cfg.user, interface_cfg.wg_configfile):
+                    print(f'  Moved it to {os.path.realpath(interface_cfg.wg_configfile)} (linked) so that it can be written crash-safe.')
         if os.path.exists(cfg.sslcertfile):
             print(f'Ensuring ownership of server certificate file {cfg.sslcertfile}.')
             chown(cfg.user, cfg.sslcertfile)
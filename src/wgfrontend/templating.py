@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""Loading of the Jinja templates: hot reload in debug mode, precompiled with persistent bytecode cache otherwise"""
+
+import hashlib
+import jinja2
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class Templates():
+    """Provides the templates of the web application"""
+
+    def __init__(self, templatedir, cachedir=None, debug=False, filters=None, globals=None):
+        """Initialize for the templates in "templatedir"; compiled templates are cached in "cachedir" (if given) unless in debug mode"""
+        self.templatedir = templatedir
+        self.debug = debug
+        bytecode_cache = None
+        if not debug and cachedir:
+            try:
+                os.makedirs(cachedir, mode=0o750, exist_ok=True)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(cachedir)
+            except OSError as e:
+                logger.warning(f'Could not create template cache directory [{cachedir}]: [{e}]')
+        self.env = jinja2.Environment(loader=jinja2.FileSystemLoader(templatedir),
+                                      bytecode_cache=bytecode_cache,
+                                      auto_reload=debug)
+        self.env.filters.update(filters or dict()) # needed before compiling
+        self.env.globals.update(globals or dict())
+        self._templates = dict()
+        self.fingerprint = None # hash of the precompiled template sources
+        if not debug:
+            self.precompile()
+
+    def precompile(self):
+        """Compile (or load from the bytecode cache) all templates so that requests don't need to look them up"""
+        sources = hashlib.sha256()
+        for name in self.env.list_templates(extensions=['html']):
+            self._templates[name] = self.env.get_template(name)
+            sources.update(self.env.loader.get_source(self.env, name)[0].encode('utf-8'))
+        self.fingerprint = sources.hexdigest()[:32]
+
+    def get_template(self, name):
+        """Get the template with the given name"""
+        tmpl = self._templates.get(name)
+        if tmpl is None:
+            tmpl = self.env.get_template(name) # checks for changes of the file in debug mode
+        return tmpl
@@ -3,55 +3,157 @@
 
 
 import cherrypy
-import jinja2
+import csv
+import io
 import logging
 import os
-import random
-import string
-import subprocess
+import threading
+import time
 
+from . import api
+from . import assets
+from . import authguard
+from . import interfaces
+from . import metrics
+from . import prefork
+from . import procpool
+from . import profiling
 from . import pwdtools
 from . import setupenv
+from . import templating
+from . import wgkeys
+from . import wgstatus
+from . import zipstream
 from . import wgcfg
 
 
+METRICS_SHARE_INTERVAL = 5 # seconds between writes of the metrics of a worker process for the other workers
+
+
 class WebApp():
 
-    def __init__(self, cfg):
-        """Instance initialization"""
+    def __init__(self, cfg, worker=None):
+        """Instance initialization; "worker" is the index of the worker process if there are several"""
         self.cfg = cfg
-        self.jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')))
-        self.wg = wgcfg.WGCfg(self.cfg.wg_configfile, self.cfg.libdir, self.on_change_func)
+        script_path = os.path.dirname(os.path.abspath(__file__))
+        self.static = assets.Assets(os.path.join(script_path, 'webroot', 'static'), os.path.join(self.cfg.libdir, 'assets'), debug=self.cfg.debug)
+        self.templates = templating.Templates(os.path.join(script_path, 'templates'),
+                                              os.path.join(self.cfg.libdir, 'templatecache'), debug=self.cfg.debug,
+                                              filters={ 'format_bytes': wgstatus.format_bytes, 'format_handshake': wgstatus.format_handshake },
+                                              globals={ 'asset_url': self.static.url })
+        wgkeys.set_backend(self.cfg.key_backend)
+        procpool.max_workers = self.cfg.process_pool_size or (max((os.cpu_count() or 1) // self.cfg.workers, 1) if self.cfg.workers > 1 else None)
+        profiling.task_threshold = self.cfg.slow_request_threshold if self.cfg.profiling else None
+        self.login_throttle = authguard.LoginThrottle(rate=self.cfg.login_rate, burst=self.cfg.login_burst)
+        self.password_verifier = authguard.PasswordVerifier(workers=self.cfg.login_workers, queue_limit=self.cfg.login_queue_limit)
+        self.interfaces = interfaces.InterfaceRegistry(self.cfg.interfaces, shared=self.cfg.workers > 1, # the first worker polls the status for all
+                                                       statedir=get_statedir(self.cfg) if worker is not None else None, poll_status=not worker)
+        self.api = api.Api(self.interfaces, self.cfg.api_tokens)
+        self.page_version = wgcfg.get_config_hash(f'{self.templates.fingerprint}{sorted(self.static.urls.items())}') # part of the ETags of pages
+        self.register_metrics()
 
     @cherrypy.expose
-    def index(self, action=None, id=None, description=None):
+    def index(self, action=None, id=None, description=None, page=1, page_size=None, search='', sort='description'):
+        iface = self.get_interface()
         if (action == 'delete') and id:
-            peer, peerdata = self.wg.get_peer_byid(id)
-            self.wg.delete_peer(peer)
-        peers = self.wg.get_peers()
-        tmpl = self.jinja_env.get_template('index.html')
-        return tmpl.render(sessiondata=cherrypy.session, peers=peers)
+            peer, peerdata = self.get_peer(iface.wg, id)
+            iface.wg.delete_peer(peer)
+        else:
+            apply_status = iface.apply_scheduler.get_status()
+            self.check_page_etag(iface, self.cfg.page_size, iface.status_poller.get_snapshot()['timestamp'],
+                                 apply_status['state'], apply_status['runs'], apply_status['last_success'])
+        page = self.parse_int(page, 1, minimum=1)
+        page_size = self.parse_int(page_size, self.cfg.page_size, minimum=1, maximum=1000)
+        if sort.lstrip('-') not in wgcfg.SORT_KEYS:
+            sort = 'description'
+        with profiling.phase('query'):
+            total, peers = iface.wg.get_peers_page(search=search, sort=sort, offset=(page - 1) * page_size, limit=page_size)
+            pages = max((total + page_size - 1) // page_size, 1)
+            if page > pages:
+                page = pages
+                total, peers = iface.wg.get_peers_page(search=search, sort=sort, offset=(page - 1) * page_size, limit=page_size)
+        status = { peer: iface.status_poller.get_peer_status(peer) for peer, peerdata in peers }
+        return self.render_template('index.html', sessiondata=cherrypy.session, peers=peers, total=total, page=page, pages=pages, page_size=page_size,
+                                    search=search, sort=sort, status=status, apply_status=iface.apply_scheduler.get_status())
+
+    def get_interface(self):
+        """Get the interface selected in the session of the current request (the first one by default)"""
+        session = getattr(cherrypy.serving, 'session', None)
+        try:
+            return self.interfaces.get(session.get('interface') if session is not None else None)
+        except KeyError: # no longer configured
+            return self.interfaces.default
+
+    @cherrypy.expose
+    def select(self, interface=None):
+        """Select the interface to be shown and managed in this session"""
+        if interface in self.interfaces.names:
+            cherrypy.session['interface'] = interface
+        raise cherrypy.HTTPRedirect('/', 302)
+
+    def check_page_etag(self, iface, *parts):
+        """Set a weak ETag derived from the config of the interface, the user and the given parts of the page state;
+           responds with "304 Not Modified" before the page is rendered if the client's copy is current"""
+        if self.cfg.debug or (cherrypy.request.method not in ['GET', 'HEAD']):
+            return
+        state = '\n'.join(str(part) for part in (self.page_version, iface.name, iface.wg.get_config_etag(), cherrypy.session.get('username')) + parts)
+        cherrypy.response.headers['ETag'] = f'W/"{wgcfg.get_config_hash(state)}"'
+        cherrypy.response.headers['Cache-Control'] = 'private, no-cache' # always revalidate
+        cherrypy.lib.cptools.validate_etags() # responds with "304 Not Modified" if the ETag matches
+
+    def render_template(self, name, **context):
+        """Render the template with the given name"""
+        context.setdefault('interfaces', self.interfaces.names)
+        context.setdefault('interface', self.get_interface().name)
+        with profiling.phase('render'):
+            return self.templates.get_template(name).render(**context)
+
+    @staticmethod
+    def get_peer(wg, id):
+        """Get the public key and client data of the client with the given identifier (404 if it doesn't exist)"""
+        peer, peerdata = wg.get_peer_byid(id)
+        if peer is None:
+            raise cherrypy.NotFound()
+        return peer, peerdata
+
+    @staticmethod
+    def parse_int(value, default, minimum=None, maximum=None):
+        """Convert a request parameter to an integer within the given bounds"""
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return default
+        if (minimum is not None) and (value < minimum):
+            value = minimum
+        if (maximum is not None) and (value > maximum):
+            value = maximum
+        return value
 
     @cherrypy.expose
     def config(self, action=None, id=None, description=None):
+        iface = self.get_interface()
         peerdata = None
+        if action != 'save':
+            self.check_page_etag(iface, iface.status_poller.get_snapshot()['timestamp'])
         if (action == 'save') and id:
-            peer, peerdata = self.wg.get_peer_byid(id)
-            peerdata = self.wg.update_peer(peer, description)
+            peer, peerdata = self.get_peer(iface.wg, id)
+            peerdata = iface.wg.update_peer(peer, description)
         if (action == 'save') and not id:
-            peer = self.wg.create_peer(description)
-            peerdata = self.wg.get_peer(peer)
+            peer = iface.wg.create_peer(description)
+            peerdata = iface.wg.get_peer(peer)
         if not peerdata:
-            peer, peerdata = self.wg.get_peer_byid(id)
-        tmpl = self.jinja_env.get_template('config.html')
-        return tmpl.render(sessiondata=cherrypy.session, peerdata=peerdata)
+            peer, peerdata = self.get_peer(iface.wg, id)
+        return self.render_template('config.html', sessiondata=cherrypy.session, peerdata=peerdata, status=iface.status_poller.get_peer_status(peerdata['PublicKey']))
 
     @cherrypy.expose
     def edit(self, action='edit', id=None, description=None):
+        iface = self.get_interface()
+        if not (id and description): # nothing to save
+            self.check_page_etag(iface)
         if id: # existing client
-            peer, peerdata = self.wg.get_peer_byid(id)
+            peer, peerdata = self.get_peer(iface.wg, id)
             if description:
-                peerdata = self.wg.update_peer(peer, description)
+                peerdata = iface.wg.update_peer(peer, description)
         else:
             if not description:
                 description = 'My new client'
@@ -59,30 +161,123 @@ class WebApp():
                 peerdata = { 'Description': description, 'Id': '' }
             else: # save changes
                 raise ValueError()
-        tmpl = self.jinja_env.get_template('edit.html')
-        return tmpl.render(sessiondata=cherrypy.session, peerdata=peerdata)
+        return self.render_template('edit.html', sessiondata=cherrypy.session, peerdata=peerdata)
+
+    @cherrypy.expose
+    def bulk(self, action=None, descriptions='', csvfile=None):
+        """Create multiple clients at once from a list of descriptions or an uploaded CSV file"""
+        wg = self.get_interface().wg
+        peers = dict()
+        error_msg = ''
+        if action == 'save':
+            try:
+                entries = self.parse_bulk_input(descriptions, csvfile)
+                if not entries:
+                    raise ValueError('No clients specified')
+                created = wg.create_peers([ description for description, ip in entries ], [ ip for description, ip in entries ])
+                threading.Thread(target=wg.prerender_qrcodes, args=(created,), daemon=True).start() # fill QR code cache in the background
+                peers = { peer: wg.get_peer(peer) for peer in created }
+                descriptions = ''
+            except ValueError as e:
+                error_msg = str(e)
+        return self.render_template('bulk.html', sessiondata=cherrypy.session, peers=peers, descriptions=descriptions, error_msg=error_msg)
+
+    @staticmethod
+    def parse_bulk_input(descriptions, csvfile=None):
+        """Get a list of (description, address) tuples from a list of descriptions (one per line) or a CSV file (description[,address])"""
+        entries = []
+        if (csvfile is not None) and getattr(csvfile, 'filename', None):
+            content = csvfile.file.read().decode('utf-8-sig')
+            reader = csv.reader(io.StringIO(content))
+            for row in reader:
+                if not row or not row[0].strip() or (row[0].strip().lower() == 'description'): # skip empty lines and header
+                    continue
+                try:
+                    wgcfg.check_description(row[0].strip()) # quoted fields may contain line breaks
+                except ValueError as e:
+                    raise ValueError(f'Invalid row ending in line {reader.line_num} of the CSV file: {e}')
+                address = row[1].strip() if len(row) > 1 else ''
+                entries.append((row[0].strip(), address or None))
+        for line in descriptions.splitlines():
+            if line.strip():
+                try:
+                    wgcfg.check_description(line.strip())
+                except ValueError as e:
+                    raise ValueError(f'Invalid description [{line.strip()}]: {e}')
+                entries.append((line.strip(), None))
+        return entries
 
     @cherrypy.expose
     def download(self, id):
         """Provide the WireGuard config for the client with the given identifier for download"""
-        peer, peerdata = self.wg.get_peer_byid(id)
-        config, peerdata = self.wg.get_peerconfig(peer)
+        wg = self.get_interface().wg
+        peer, peerdata = self.get_peer(wg, id)
+        config, peerdata = wg.get_peerconfig(peer)
         cherrypy.response.headers['Content-Disposition'] = f'attachment; filename=wg_{id}.conf'
         cherrypy.response.headers['Content-Type'] = 'text/plain' # 'application/x-download' 'application/octet-stream'
         return config.encode('utf-8')
 
+    @cherrypy.expose
+    def export(self, qrcodes=None):
+        """Provide the configs (and optionally the QR codes) of all clients as ZIP archive that is streamed while it is generated"""
+        iface = self.get_interface()
+        cherrypy.response.headers['Content-Disposition'] = f'attachment; filename=wg_{iface.name}_clients.zip'
+        cherrypy.response.headers['Content-Type'] = 'application/zip'
+        cherrypy.response.headers['Cache-Control'] = 'no-store'
+        if cherrypy.session.locked:
+            cherrypy.session.release_lock() # don't block other requests of the user while streaming
+        return zipstream.stream_zip(iface.wg.iter_export(qrcodes=bool(qrcodes)))
+    export._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def qrcode(self, id):
+        """Provide the WireGuard config for the client with the given identifier as QR code image"""
+        wg = self.get_interface().wg
+        peer, peerdata = self.get_peer(wg, id)
+        png, etag = wg.get_qrcode(peer)
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Cache-Control'] = 'private, no-cache' # revalidate as the config may change
+        cherrypy.lib.cptools.validate_etags() # responds with "304 Not Modified" if the ETag matches
+        cherrypy.response.headers['Content-Type'] = 'image/png'
+        return png
+
     def check_username_and_password(self, username, password):
         """Check whether provided username and password are valid when authenticating"""
-        if (username in self.cfg.users) and (pwdtools.verify_password(self.cfg.users[username], password)):
-            cherrypy.log('Login of user: ' + username, context='WEBAPP', severity=logging.INFO, traceback=False)
-            return
+        if not self.login_throttle.allow(cherrypy.request.remote.ip):
+            cherrypy.log('Login throttled for address: ' + cherrypy.request.remote.ip, context='WEBAPP', severity=logging.WARNING, traceback=False)
+            metrics.inc('wgfrontend_logins_total', result='throttled')
+            return 'too many login attempts, please try again later'
+        if username in self.cfg.users:
+            stored_password = self.cfg.users[username]
+            try:
+                with profiling.phase('password'):
+                    valid = self.password_verifier.verify_password(stored_password, password)
+            except authguard.VerifierBusy:
+                cherrypy.log('Login rejected as the server is busy', context='WEBAPP', severity=logging.WARNING, traceback=False)
+                metrics.inc('wgfrontend_logins_total', result='busy')
+                return 'server busy, please try again later'
+            if valid:
+                cherrypy.log('Login of user: ' + username, context='WEBAPP', severity=logging.INFO, traceback=False)
+                metrics.inc('wgfrontend_logins_total', result='success')
+                if pwdtools.needs_rehash(stored_password):
+                    self.upgrade_password_hash(username, password)
+                return
         cherrypy.log('Login failed for user: ' + username, context='WEBAPP', severity=logging.WARNING, traceback=False)
+        metrics.inc('wgfrontend_logins_total', result='failure')
         return 'invalid username/password'
 
+    def upgrade_password_hash(self, username, password):
+        """Store the password of the user hashed with the current parameters"""
+        try:
+            password_hash = self.password_verifier.hash_password(password)
+        except authguard.VerifierBusy:
+            return # next time
+        if self.cfg.update_user_password(username, password_hash):
+            cherrypy.log('Upgraded password hash of user: ' + username, context='WEBAPP', severity=logging.INFO, traceback=False)
+
     def login_screen(self, from_page='..', username='', error_msg='', **kwargs):
         """Shows a login form"""
-        tmpl = self.jinja_env.get_template('login.html')
-        return tmpl.render(from_page=from_page, username=username, error_msg=error_msg).encode('utf-8')
+        return self.render_template('login.html', from_page=from_page, username=username, error_msg=error_msg).encode('utf-8')
 
     @cherrypy.expose
     def logout(self):
@@ -94,19 +289,89 @@ class WebApp():
         raise cherrypy.HTTPRedirect('/', 302)        
         return '"{0}" has been logged out'.format(username)
 
-    def on_change_func(self):
-        """React on config changes"""
-        on_change_command = self.cfg.on_change_command
-        if (on_change_command is not None) and (len(on_change_command) > 0):
-            returncode = subprocess.call(on_change_command, shell=True)
-            if returncode != 0:
-                cherrypy.log('Error calling on_change_command', context='WEBAPP', severity=logging.ERROR, traceback=False)
+    def register_metrics(self):
+        """Register the gauges describing the state of the application"""
+        def per_interface(func):
+            return lambda: [ ({ 'interface': iface.name }, func(iface)) for iface in self.interfaces ]
+        def per_pool(func):
+            return lambda: [ ({ 'interface': iface.name, 'family': f'ipv{pool.network.version}' }, func(pool)) for iface in self.interfaces for pool in iface.wg.pools ]
+        metrics.register_gauge('wgfrontend_peers', 'Number of configured peers', per_interface(lambda iface: iface.wg.cache_info()['size']))
+        metrics.register_gauge('wgfrontend_config_generation', 'Number of changes of the config data since startup', per_interface(lambda iface: iface.wg.generation))
+        metrics.register_gauge('wgfrontend_address_pool_size', 'Number of addresses usable for peers', per_pool(lambda pool: pool.size))
+        metrics.register_gauge('wgfrontend_address_pool_used', 'Number of addresses in use', per_pool(lambda pool: pool.used))
+        metrics.register_gauge('wgfrontend_address_pool_utilization', 'Share of usable addresses in use', per_pool(lambda pool: pool.utilization))
+        metrics.register_gauge('wgfrontend_qrcode_cache_entries', 'Number of rendered QR codes in the cache', per_interface(lambda iface: iface.wg.qrcodes.cache_info()['size']))
+        metrics.register_gauge('wgfrontend_apply_pending', 'Whether config changes are waiting to be applied', per_interface(lambda iface: int(iface.apply_scheduler.state != 'idle')))
+
+    @cherrypy.expose
+    def metrics(self):
+        """Provide internal metrics in the Prometheus text format"""
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.render().encode('utf-8')
+
+
+def reload_wgconfig():
+    """Re-read the WireGuard configs before handling a request in case they have been changed externally"""
+    with profiling.phase('reload'):
+        cherrypy.request.app.root.interfaces.reload_if_changed()
+
+cherrypy.tools.reload_wgconfig = cherrypy.Tool('before_handler', reload_wgconfig, priority=60) # after session_auth
+
+class RequestMetricsTool(cherrypy.Tool):
+    """Tool recording the number and the duration of requests per handler"""
+
+    def __init__(self):
+        """Initialize the tool"""
+        cherrypy.Tool.__init__(self, 'on_start_resource', self.start_request)
+
+    def _setup(self):
+        """Hook into the request (called by CherryPy)"""
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach('on_end_request', self.end_request)
+
+    def start_request(self):
+        """Remember the start of the request and the handler (before other tools wrap it)"""
+        cherrypy.request.metrics_start = time.perf_counter()
+        cherrypy.request.metrics_handler = getattr(getattr(cherrypy.request.handler, 'callable', None), '__qualname__', 'other')
 
+    def end_request(self):
+        """Record the request after the response has been sent"""
+        duration = time.perf_counter() - cherrypy.request.metrics_start
+        handler = cherrypy.request.metrics_handler
+        metrics.inc('wgfrontend_http_requests_total', handler=handler, code=str(cherrypy.response.status)[:3])
+        metrics.observe('wgfrontend_http_request_duration_seconds', duration, handler=handler)
+
+cherrypy.tools.request_metrics = RequestMetricsTool()
+
+def get_statedir(cfg):
+    """Get the directory in which worker processes share the status of the interfaces and their metrics"""
+    return os.path.join(cfg.libdir, 'state')
+
+def prepare_dir(cfg, dirname):
+    """Create the given directory for the system user of the web frontend"""
+    os.makedirs(dirname, mode=0o700, exist_ok=True)
+    if setupenv.is_root():
+        setupenv.chown(cfg.user, dirname)
 
 def run_webapp(cfg):
     """Runs the CherryPy web application with the provided configuration data"""
+    if cfg.session_storage == 'file':
+        prepare_dir(cfg, os.path.join(cfg.libdir, 'sessions'))
+    if cfg.workers > 1:
+        statedir = get_statedir(cfg)
+        prepare_dir(cfg, statedir)
+        for filename in os.listdir(statedir): # metrics of a previous run (possibly with more workers)
+            if filename.startswith('metrics-'):
+                os.unlink(os.path.join(statedir, filename))
+        # The workers inherit the listening socket (bound before dropping privileges) and run the application each
+        prefork.run(cfg.workers, cfg.socket_host, cfg.socket_port, lambda worker: serve_webapp(cfg, worker))
+    else:
+        serve_webapp(cfg)
+
+def serve_webapp(cfg, worker=None):
+    """Runs the CherryPy web application in the current process ("worker" is the index of the worker process if there are several)"""
     script_path = os.path.dirname(os.path.abspath(__file__))
-    app = WebApp(cfg)
+    app = WebApp(cfg, worker)
     # Use SSL if certificate files exist
     ssl = os.path.exists(cfg.sslcertfile) and os.path.exists(cfg.sslkeyfile)
     if ssl:
@@ -137,26 +402,64 @@ def run_webapp(cfg):
             'tools.session_auth.on': True,
             'tools.session_auth.login_screen': app.login_screen,
             'tools.session_auth.check_username_and_password': app.check_username_and_password,
+            'tools.reload_wgconfig.on': True,
+            'tools.gzip.on': True,
+            'tools.gzip.mime_types': ['text/html', 'text/plain', 'application/json'],
+            'tools.request_metrics.on': True,
+            'tools.profiling.on': cfg.profiling,
+            'tools.profiling.threshold': cfg.slow_request_threshold,
+            'tools.profiling.sample_rate': cfg.profile_sample_rate,
+            'tools.profiling.dumpdir': os.path.join(cfg.libdir, 'profiles'),
             },
-        '/configs': {
-            'tools.staticdir.on': True,
-            'tools.staticdir.root': None,
-            'tools.staticdir.dir': cfg.libdir
+        '/api': {
+            'tools.sessions.on': False,
+            'tools.session_auth.on': False,
+            'tools.api_token.on': True,
+            'tools.json_in.on': True,
+            'error_page.default': api.json_error_page,
+        },
+        '/api/peers': {
+            'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+        },
+        '/metrics': {
+            'tools.sessions.on': False,
+            'tools.session_auth.on': False,
+            'tools.reload_wgconfig.on': False,
+            'tools.api_token.on': True,
         },
         '/static': {
+            'tools.gzip.on': False, # served precompressed
+            'tools.sessions.on': False,
             'tools.session_auth.on': False,
-            'tools.staticdir.on': True,
-            'tools.staticdir.dir': 'static'
+            'tools.reload_wgconfig.on': False,
         },
         '/favicon.ico':
         {
+            'tools.sessions.on': False,
             'tools.session_auth.on': False,
+            'tools.reload_wgconfig.on': False,
             'tools.staticfile.on': True,
-            'tools.staticfile.filename': os.path.join(script_path, 'webroot', 'static', 'favicon.ico')
+            'tools.staticfile.filename': os.path.join(script_path, 'webroot', 'static', 'favicon.ico'),
+            'tools.expires.on': True,
+            'tools.expires.secs': 86400,
         }
     }
+    if cfg.session_storage == 'file':
+        # Sessions are shared with the other worker processes and survive restarts
+        app_conf['/'].update({'tools.sessions.storage_class': cherrypy.lib.sessions.FileSession,
+                              'tools.sessions.storage_path': os.path.join(cfg.libdir, 'sessions'),
+                             })
     # Start CherryPy
     cherrypy.tree.mount(app, config=app_conf)
+    cherrypy.engine.subscribe('start', app.interfaces.start, priority=80) # after dropping privileges
+    cherrypy.engine.subscribe('stop', app.interfaces.stop) # don't lose pending changes on shutdown
+    cherrypy.engine.subscribe('stop', procpool.shutdown)
+    cherrypy.engine.subscribe('stop', app.password_verifier.shutdown)
+    if worker is not None:
+        # Each worker records its own metrics; /metrics renders the sum of all of them, whichever worker answers
+        metrics.share_values(get_statedir(cfg), f'worker{worker}')
+        cherrypy.process.plugins.Monitor(cherrypy.engine, metrics.write_shared, frequency=METRICS_SHARE_INTERVAL, name='metrics').subscribe()
+        cherrypy.engine.subscribe('stop', metrics.write_shared)
     if setupenv.is_root():
         # Drop privileges
         uid, gid = setupenv.get_uid_gid(cfg.user, cfg.user)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""Apply peer changes to a running WireGuard interface without taking it down"""
+
+import logging
+import shlex
+import subprocess
+
+
+logger = logging.getLogger(__name__)
+
+
+class LiveApplier():
+    """Pushes the difference between the last applied and the current peer set to the running interface using "wg set"/"wg syncconf" """
+
+    def __init__(self, interface, wg_command='wg'):
+        """Initialize for the given interface; "wg_command" is the command line for invoking the wg tool (e.g. with sudo)"""
+        self.interface = interface
+        self.wg_command = shlex.split(wg_command)
+        self._applied = None # peer states of the last successful apply (None if unknown)
+
+    def execute(self, args, input=None):
+        """Execute the wg tool with the given arguments; returns whether it succeeded"""
+        command = self.wg_command + args
+        command_text = ' '.join(command)
+        try:
+            result = subprocess.run(command, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        except OSError as e:
+            logger.error(f'Could not execute [{command_text}]: [{e}]')
+            return False
+        if result.returncode != 0:
+            logger.error(f'Command [{command_text}] failed: [{result.stderr.strip()}]')
+            return False
+        return True
+
+    @staticmethod
+    def diff(old, new):
+        """Get lists of removed peers and of added or changed peers between two peer state dictionaries"""
+        removed = [ peer for peer in old if peer not in new ]
+        changed = [ peer for peer, state in new.items() if old.get(peer) != state ]
+        return removed, changed
+
+    def set_peers(self, removed, changed, peerstates):
+        """Remove and add/update the given peers using "wg set" """
+        if removed:
+            args = ['set', self.interface]
+            for peer in removed:
+                args.extend(['peer', peer, 'remove'])
+            if not self.execute(args):
+                return False
+        for peer in changed: # one call per peer as the preshared key is passed via stdin
+            state = peerstates[peer]
+            args = ['set', self.interface, 'peer', peer]
+            if state['PresharedKey']:
+                args.extend(['preshared-key', '/dev/stdin'])
+            args.extend(['allowed-ips', ','.join(state['AllowedIPs'])])
+            args.extend(['persistent-keepalive', str(state['PersistentKeepalive'] or 'off')])
+            if not self.execute(args, input=state['PresharedKey'] + '\n' if state['PresharedKey'] else None):
+                return False
+        return True
+
+    def sync(self, stripped_config):
+        """Synchronize the interface with the given config (without wg-quick attributes) using "wg syncconf" """
+        return self.execute(['syncconf', self.interface, '/dev/stdin'], input=stripped_config)
+
+    def apply(self, wg):
+        """Apply the current peers of the given WGCfg instance to the interface; returns whether it succeeded"""
+        peerstates = wg.get_peerstates()
+        if self._applied is None:
+            logger.info(f'Synchronizing all peers of interface [{self.interface}]')
+            success = self.sync(wg.get_stripped_config())
+        else:
+            removed, changed = self.diff(self._applied, peerstates)
+            if not removed and not changed:
+                return True
+            logger.info(f'Applying changes to interface [{self.interface}]: {len(removed)} peer(s) removed, {len(changed)} peer(s) added/changed')
+            success = self.set_peers(removed, changed, peerstates)
+            if not success:
+                logger.warning('Incremental apply failed, falling back to synchronizing all peers')
+                success = self.sync(wg.get_stripped_config())
+        self._applied = peerstates if success else None
+        return success
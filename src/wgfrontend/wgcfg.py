@@ -1,33 +1,197 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import bisect
+import contextlib
+import hashlib
+import io
 import ipaddress
 import logging
 import os
 import qrcode
 import textwrap
+import threading
+import unicodedata
 import wgconfig
-import wgconfig.wgexec as wgexec
+
+from . import addrpool
+from . import cfgstore
+from . import filewatch
+from . import lrucache
+from . import metrics
+from . import procpool
+from . import profiling
+from . import rwlock
+from . import wgkeys
 
 
 logger = logging.getLogger(__name__)
 
 
+def get_config_hash(config):
+    """Get a hash of the given client config (used in cache keys and ETags)"""
+    return hashlib.sha256(config.encode('utf-8')).hexdigest()[:32]
+
+def check_description(description):
+    """Check that the description fits into a single comment line of the config file; raises ValueError otherwise
+       (a line break would allow injecting arbitrary config lines, e.g. PostUp commands run by wg-quick as root)"""
+    if not isinstance(description, str):
+        raise ValueError('The description must be a string')
+    for char in description:
+        if unicodedata.category(char) in ('Cc', 'Zl', 'Zp'): # control characters incl. CR/LF, line and paragraph separators
+            raise ValueError('The description must not contain line breaks or control characters')
+
+def as_list(value):
+    """Get the values of an attribute as list (wgconfig returns a string for a single value and a list for several ones)"""
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def get_address_sortkey(address):
+    """Get a key for sorting addresses numerically"""
+    try:
+        ip = ipaddress.ip_interface(address).ip
+    except ValueError:
+        return (99, 0)
+    return (ip.version, int(ip))
+
+SORT_KEYS = {
+    'description': lambda peerdata: (peerdata['Description'].lower(), peerdata['Id']),
+    'address': lambda peerdata: (get_address_sortkey(peerdata['Address']), peerdata['Id']),
+}
+
+
+def render_qrcode(config):
+    """Render the given client config as QR code and return it as PNG data"""
+    qr = qrcode.QRCode(version=15, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=2, border=5)
+    qr.add_data(config)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color='black', back_color='white')
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
 class WGCfg():
     """Class for reading/writing the WireGuard configuration file"""
 
-    def __init__(self, filename, libdir, on_change_func=None):
-        """Initialize instance for the given config file"""
+    def __init__(self, filename, libdir, on_change_func=None, reserved_addresses=None, qrcode_cache_size=256, backup_count=10, commit_window=0.0, shared=False):
+        """Initialize instance for the given config file; "shared" is to be set if other processes change the file as well"""
         self.filename = filename
         self.libdir = libdir
         self.on_change_func = on_change_func
+        self.lock = rwlock.RWLock() # many readers or one writer (shared between the threads of the web server)
+        self._cache_lock = threading.Lock() # guards the data that readers compute lazily or count while holding the read lock
+        self.reserved_addresses = addrpool.parse_ranges(reserved_addresses) if isinstance(reserved_addresses, str) else reserved_addresses
         self.wc = wgconfig.WGConfig(self.filename)
+        self.qrcodes = lrucache.LRUCache(qrcode_cache_size) # (id, config hash) -> PNG data
+        self.generation = 0 # incremented whenever the config data changes
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._etag = None
+        self._etag_generation = None
+        self.watcher = filewatch.FileWatcher(os.path.realpath(self.filename)) # the directory of the actual file is watched
+        self.store = cfgstore.ConfigStore(self.filename, os.path.join(self.libdir, 'backups'), backup_count, commit_window)
+        self.filelock = cfgstore.FileLock(os.path.join(self.libdir, os.path.basename(self.filename) + '.lock')) if shared else None
+        self.read_file()
+
+    @rwlock.write_locked
+    def read_file(self):
+        """Read the config file and rebuild all cached data"""
+        self.watcher.update() # before reading so that changes while reading are detected later
         self.wc.read_file()
+        self._server_publickey = None
+        self.build_indexes()
+        self.invalidate_cache()
+        self._generation_written = self.generation
+
+    @rwlock.read_locked
+    def get_config_text(self):
+        """Get the content of the config file as held in memory"""
+        with self._cache_lock:
+            self._generation_written = self.generation
+        return ''.join(line + '\n' for line in self.wc.lines)
+
+    def write_file(self):
+        """Write the config file (crash-safe, batched with concurrent writes); must not be called holding the write lock"""
+        with metrics.timer('wgfrontend_config_write_duration_seconds'), profiling.phase('write'):
+            self.store.commit(self.get_config_text)
+        self.watcher.update()
+
+    @contextlib.contextmanager
+    def modifying(self):
+        """Context manager enclosing a change incl. writing the file; if the file is shared with other processes,
+           they are locked out and the data in memory is brought up to date before the change"""
+        if self.filelock is None:
+            yield
+            return
+        with self.filelock:
+            self.reload_if_changed()
+            yield
+
+    def list_backups(self):
+        """Get the names of the backups of previous versions of the config file, newest first"""
+        return self.store.list_backups()
+
+    def restore_backup(self, name):
+        """Roll back the config file to the given backup"""
+        with self.modifying():
+            self.store.restore_backup(name)
+            self.read_file()
+        self.config_change_done()
+
+    def reload_if_changed(self):
+        """Re-read the config file in case it has been changed externally; returns whether it has been reloaded"""
+        if not self.watcher.check():
+            return False
+        with self.lock.writing():
+            if self.generation != self._generation_written:
+                return False # changes in memory are about to be written; don't discard them
+            if not self.watcher.check():
+                return False # already reloaded by another thread
+            logger.info(f'Config file [{self.filename}] changed externally, reloading')
+            self.read_file()
+        return True
+
+    def invalidate_cache(self):
+        """Discard the cached client data so that it is rebuilt on next access (to be called holding the write lock)"""
+        self.wc.peers # parse now so that readers never trigger parsing
+        self._peers_cache = None
+        self.generation += 1
+
+    @rwlock.read_locked
+    def get_config_etag(self):
+        """Get an entity tag for the current config data (computed once per change)"""
+        with self._cache_lock:
+            if self._etag_generation == self.generation:
+                return self._etag
+        etag = '"' + get_config_hash('\n'.join(self.wc.lines)) + '"' # computed outside the mutex; concurrent readers get the same result
+        with self._cache_lock:
+            self._etag = etag
+            self._etag_generation = self.generation
+        return etag
+
+    @rwlock.read_locked
+    def cache_info(self):
+        """Get statistics on the cache of client data"""
+        with self._cache_lock:
+            return { 'hits': self.cache_hits, 'misses': self.cache_misses, 'generation': self.generation, 'size': len(self._peers_bykey) }
 
     def get_interface(self):
         """Get WireGuard interface data"""
         return self.wc.interface
 
+    @rwlock.read_locked
+    def get_server_publickey(self):
+        """Get the public key of the interface (derived once from its private key)"""
+        with self._cache_lock:
+            if self._server_publickey is not None:
+                return self._server_publickey
+        public_key = wgkeys.get_publickey(self.get_interface()['PrivateKey']) # derived outside the mutex; concurrent readers get the same result
+        with self._cache_lock:
+            self._server_publickey = public_key
+        return public_key
+
     def transform_to_clientdata(self, peer, peerdata):
         """Transform data of a single peer from server into a dictionary of client config data"""
         result = dict()
@@ -42,31 +206,150 @@ class WGCfg():
                 result['PrivateKey'] = item[15:]
         result['PublicKey'] = peer
         result['PresharedKey'] = peerdata['PresharedKey']
-        address = peerdata['AllowedIPs'].partition(',')[0] # get first allowed ip range
-        address = address.partition('/')[0] + '/' + self.get_interface()['Address'].partition('/')[2] # take prefix length from interface address
+        allowed_ips = as_list(peerdata['AllowedIPs'])
+        address = self.pick_address(allowed_ips, self.pool.network.version) or allowed_ips[0] # allowed ip of the family of the interface's first address
+        address = address.partition('/')[0] + '/' + str(self.pool.network.prefixlen) # take prefix length from interface address
         result['Address'] = address
-        result['Id'] = address.partition('/')[0].replace('.', '-')
-        result['QRCode'] = os.path.join(self.libdir, result['Id'] + '.png')
+        result['Id'] = address.partition('/')[0].replace('.', '-').replace(':', '-')
+        address6 = self.pick_address(allowed_ips, 6) if self.pool6 is not None else None
+        result['Address6'] = address6.partition('/')[0] + '/' + str(self.pool6.network.prefixlen) if address6 else ''
         return result
 
+    @staticmethod
+    def pick_address(allowed_ips, version):
+        """Get the first of the allowed ips of the given IP version (checking the notation only as this is done for all peers)"""
+        for allowed_ip in allowed_ips:
+            if (':' in allowed_ip) == (version == 6):
+                return allowed_ip.strip()
+        return None
+
+    def build_indexes(self):
+        """Build the in-memory indexes for looking up peers (once per parse of the config data)"""
+        self._peers_bykey = dict() # public key -> client data
+        self._peers_byid = dict() # id -> public key
+        self._peers_byaddress = dict() # address (without prefix length) -> public key
+        self._peers_sorted = None # sort order -> sorted list of (sort key, public key); built after all peers are indexed
+        interface_addresses = [ ipaddress.ip_interface(address.strip()) for address in as_list(self.get_interface()['Address']) ]
+        interface_addresses.sort(key=lambda address: address.version) # IPv4 first
+        self.pool = addrpool.create_pool(interface_addresses[0].network, self.reserved_addresses)
+        self.pool6 = None # second pool for the IPv6 addresses of dual-stack peers
+        interface_address6 = next(( address for address in interface_addresses if address.version == 6 ), None)
+        if (self.pool.network.version == 4) and (interface_address6 is not None):
+            self.pool6 = addrpool.create_pool(interface_address6.network, self.reserved_addresses)
+        for pool in self.pools:
+            for address in interface_addresses:
+                pool.mark_used(address.ip)
+        for peer, peerdata in self.wc.peers.items():
+            self.index_peer(peer, self.transform_to_clientdata(peer, peerdata))
+        self._peers_sorted = { order: sorted((sortkey(peerdata), peer) for peer, peerdata in self._peers_bykey.items())
+                               for order, sortkey in SORT_KEYS.items() }
+
+    def index_peer(self, peer, peerdata):
+        """Add the client data of the given peer to the indexes"""
+        self._peers_bykey[peer] = peerdata
+        self._peers_byid[peerdata['Id']] = peer
+        self._peers_byaddress[peerdata['Address'].partition('/')[0]] = peer
+        self.pool.mark_used(peerdata['Address'].partition('/')[0])
+        if peerdata['Address6']:
+            self._peers_byaddress[peerdata['Address6'].partition('/')[0]] = peer
+            self.pool6.mark_used(peerdata['Address6'].partition('/')[0])
+        if self._peers_sorted is not None:
+            for order, sortkey in SORT_KEYS.items():
+                bisect.insort(self._peers_sorted[order], (sortkey(peerdata), peer))
+
+    def unindex_peer(self, peer):
+        """Remove the given peer from the indexes"""
+        peerdata = self._peers_bykey.pop(peer, None)
+        if peerdata is None:
+            return
+        self._peers_byid.pop(peerdata['Id'], None)
+        self._peers_byaddress.pop(peerdata['Address'].partition('/')[0], None)
+        self.pool.release(peerdata['Address'].partition('/')[0])
+        if peerdata['Address6']:
+            self._peers_byaddress.pop(peerdata['Address6'].partition('/')[0], None)
+            self.pool6.release(peerdata['Address6'].partition('/')[0])
+        if self._peers_sorted is not None:
+            for order, sortkey in SORT_KEYS.items():
+                entries = self._peers_sorted[order]
+                i = bisect.bisect_left(entries, (sortkey(peerdata), peer))
+                if (i < len(entries)) and (entries[i][1] == peer):
+                    del entries[i]
+
+    @rwlock.read_locked
     def get_peer(self, peer):
         """Get data of the given WireGuard peer"""
         if peer is None:
             return None
-        return self.transform_to_clientdata(peer, self.wc.peers[peer])
+        return self._peers_bykey[peer]
 
+    @rwlock.read_locked
     def get_peers(self):
-        """Get data of all WireGuard peers"""
-        return { peer: self.get_peer(peer) for peer in self.wc.peers.keys() }
+        """Get data of all WireGuard peers (the returned dictionary is shared and must not be modified)"""
+        with self._cache_lock:
+            if self._peers_cache is None:
+                self.cache_misses += 1
+                self._peers_cache = dict(self._peers_bykey)
+            else:
+                self.cache_hits += 1
+            return self._peers_cache
+
+    @rwlock.read_locked
+    def get_peers_page(self, search='', sort='description', offset=0, limit=50):
+        """Get the total number of matching peers and a slice of (public key, client data) tuples;
+           "search" is matched against description and address, "sort" may be prefixed with "-" for descending order"""
+        entries = self._peers_sorted.get(sort.lstrip('-'))
+        if entries is None:
+            raise ValueError(f'Unknown sort order [{sort}]')
+        search = search.strip().lower()
+        if search:
+            entries = [ (sortkey, peer) for sortkey, peer in entries
+                        if (search in self._peers_bykey[peer]['Description'].lower()) or (search in self._peers_bykey[peer]['Address']) or (search in self._peers_bykey[peer]['Address6']) ]
+        total = len(entries)
+        if sort.startswith('-'): # only reverse the visible slice
+            selected = entries[max(total - offset - limit, 0):max(total - offset, 0)][::-1]
+        else:
+            selected = entries[offset:offset + limit]
+        return total, [ (peer, self._peers_bykey[peer]) for sortkey, peer in selected ]
 
+    @rwlock.read_locked
     def get_peer_byid(self, id):
         """Get data WireGuard peer with the given id"""
-        try:
-            peer = next(peer for peer, peerdata in self.get_peers().items() if peerdata['Id'] == id)
-        except StopIteration:
-            peer = None
+        peer = self._peers_byid.get(id)
         return peer, self.get_peer(peer)
 
+    @rwlock.read_locked
+    def get_peer_byaddress(self, address):
+        """Get data of the WireGuard peer with the given address (prefix length is ignored)"""
+        peer = self._peers_byaddress.get(str(address).partition('/')[0])
+        return peer, self.get_peer(peer)
+
+    @rwlock.read_locked
+    def get_peerstates(self):
+        """Get the attributes relevant for the running interface of all enabled peers"""
+        result = dict()
+        for peer, peerdata in self.wc.peers.items():
+            if peerdata.get('_disabled'):
+                continue
+            allowed_ips = [ allowed_ip.strip() for value in as_list(peerdata.get('AllowedIPs')) for allowed_ip in value.split(',') ]
+            result[peer] = { 'PresharedKey': peerdata.get('PresharedKey'),
+                             'AllowedIPs': tuple(filter(None, allowed_ips)), # normalized so that "wg set" accepts them and notation does not matter when diffing
+                             'PersistentKeepalive': peerdata.get('PersistentKeepalive')
+                           }
+        return result
+
+    @rwlock.read_locked
+    def get_stripped_config(self):
+        """Get the config without the attributes only understood by wg-quick (like "wg-quick strip")"""
+        wgquick_attrs = ('Address', 'DNS', 'MTU', 'Table', 'PreUp', 'PostUp', 'PreDown', 'PostDown', 'SaveConfig')
+        lines = []
+        for line in self.wc.lines:
+            attr = line.partition('=')[0].strip()
+            if line.lstrip().startswith('#') or (attr in wgquick_attrs):
+                continue
+            lines.append(line)
+        return '\n'.join(lines) + '\n'
+
+    @rwlock.read_locked
     def get_peerconfig(self, peer):
         """Get config for the given WireGuard peer"""
         if peer is None:
@@ -77,15 +360,15 @@ class WGCfg():
                 endpoint = item[13:]
             if item.startswith('# Networks = '):
                 allowed_ips = item[13:]
-        public_key = wgexec.get_publickey(peerdata['PrivateKey'])
-        public_key_server = wgexec.get_publickey(self.get_interface()['PrivateKey'])
+        public_key = peer # the public key of the peer is the key of its section
+        public_key_server = self.get_server_publickey()
         config = textwrap.dedent(f'''\
             # {peerdata['Description']}
             [Interface]
             ListenPort = 51820
             PrivateKey = {peerdata['PrivateKey']}
             # PublicKey = {public_key}
-            Address = {peerdata['Address']}
+            Address = {', '.join(filter(None, [peerdata['Address'], peerdata['Address6']]))}
             
             [Peer]
             Endpoint = {endpoint}
@@ -96,68 +379,181 @@ class WGCfg():
         ''')
         return config, peerdata
 
+    def add_peer_lines(self, peer, description, private_key, preshared_key, ip, ip6=None):
+        """Append the config lines of a new peer (same layout as created by adding the peer attribute by attribute)"""
+        allowed_ips = f'{ip}/{ipaddress.ip_address(ip).max_prefixlen}' + (f', {ip6}/128' if ip6 else '')
+        if peer in self._peers_bykey:
+            raise KeyError('Peer to be added already exists')
+        self.wc.lines.extend(['',
+                              '# ' + description,
+                              '[Peer]',
+                              f'PublicKey = {peer}',
+                              f'# PrivateKey = {private_key}',
+                              f'PresharedKey = {preshared_key}',
+                              f'AllowedIPs = {allowed_ips}',
+                              'PersistentKeepalive = 25'
+                             ])
+        self.wc.invalidate_data()
+
     def create_peer(self, description, ip=None):
         """Create peer with the given description"""
-        if ip is None:
-            ip = self.find_free_ip()
-        private_key = wgexec.generate_privatekey()
-        peer = wgexec.get_publickey(private_key)
-        self.wc.add_peer(peer, '# ' + description)
-        comment = '# PrivateKey = ' + private_key
-        self.wc.add_attr(peer, 'PresharedKey', wgexec.generate_presharedkey(), comment, append_as_line=True)
-        self.wc.add_attr(peer, 'AllowedIPs', ip + '/32')
-        self.wc.add_attr(peer, 'PersistentKeepalive', 25)
-        self.wc.write_file()
-        self.write_qrcode(peer)
+        return self.create_peers([description], None if ip is None else [ip])[0]
+
+    def create_peers(self, descriptions, ips=None):
+        """Create peers with the given descriptions writing the config file only once; addresses being None are allocated"""
+        with self.modifying():
+            with self.lock.writing(), profiling.phase('create'): # allocation of the addresses and adding the peers must be atomic
+                peers = self.add_peers(descriptions, ips)
+            self.write_file()
         self.config_change_done()
-        return peer
-        
+        return peers
+
+    def add_peers(self, descriptions, ips=None):
+        """Add peers with the given descriptions in memory (to be called holding the write lock)"""
+        for description in descriptions:
+            check_description(description)
+        if ips is None:
+            ips = [None] * len(descriptions)
+        if len(ips) != len(descriptions):
+            raise ValueError('The number of addresses does not match the number of peers')
+        ips = [ str(ipaddress.ip_address(ip)) if ip else None for ip in ips ]
+        explicit_ips = [ ip for ip in ips if ip is not None ]
+        for ip in explicit_ips:
+            if not self.pool.is_free(ip):
+                raise ValueError(f'The address [{ip}] is not available')
+        if len(set(explicit_ips)) != len(explicit_ips):
+            raise ValueError('Addresses must be unique')
+        missing = len(ips) - len(explicit_ips)
+        if missing:
+            free_ips = iter(self.find_free_ips(missing, exclude=explicit_ips))
+            ips = [ ip if ip is not None else next(free_ips) for ip in ips ]
+        ip6s = self.find_free_ips6(ips) if self.pool6 is not None else [None] * len(ips)
+        peers = []
+        for description, ip, ip6 in zip(descriptions, ips, ip6s):
+            private_key, peer = wgkeys.generate_keypair()
+            self.add_peer_lines(peer, description, private_key, wgkeys.generate_presharedkey(), ip, ip6)
+            peers.append(peer)
+        for peer in peers:
+            self.index_peer(peer, self.transform_to_clientdata(peer, self.wc.peers[peer]))
+        self.invalidate_cache()
+        return peers
+
+    def prerender_qrcodes(self, peers):
+        """Render the QR codes of the given peers in the process pool and put them into the cache"""
+        peers = peers[:self.qrcodes.maxsize] # rendering more than fits into the cache is pointless
+        configs = [ self.get_peerconfig(peer) for peer in peers ]
+        for (config, peerdata), png in zip(configs, procpool.map_tasks(render_qrcode, [ config for config, peerdata in configs ], chunksize=8)):
+            self.qrcodes.put((peerdata['Id'], get_config_hash(config)), png)
+
+    def iter_export(self, qrcodes=False, batch_size=64):
+        """Generator yielding (file name, data, whether to compress) for the configs and optionally the QR codes of all peers;
+           works on batches of peers so that memory use doesn't depend on the number of peers"""
+        total, peers = self.get_peers_page(limit=self.cache_info()['size'])
+        peers = [ peer for peer, peerdata in peers ] # snapshot of the peers to export, sorted by description
+        pending = None
+        for start in range(0, len(peers), batch_size):
+            batch = self.prepare_export_batch(peers[start:start + batch_size], qrcodes) # QR codes are rendered while the previous batch is sent
+            if pending is not None:
+                yield from self.finish_export_batch(*pending)
+            pending = batch
+        if pending is not None:
+            yield from self.finish_export_batch(*pending)
+
+    def prepare_export_batch(self, peers, qrcodes):
+        """Get the configs of the given peers and start rendering the QR codes not in the cache in the process pool"""
+        configs = []
+        for peer in peers:
+            try:
+                configs.append(self.get_peerconfig(peer))
+            except KeyError: # deleted meanwhile
+                continue
+        pngs, rendering = None, None
+        if qrcodes:
+            pngs = [ self.qrcodes.get((peerdata['Id'], get_config_hash(config))) for config, peerdata in configs ]
+            missing = [ i for i, png in enumerate(pngs) if png is None ]
+            rendering = zip(missing, procpool.map_tasks(render_qrcode, [ configs[i][0] for i in missing ], chunksize=8))
+        return configs, pngs, rendering
+
+    def finish_export_batch(self, configs, pngs, rendering):
+        """Generator yielding the files of a batch prepared by prepare_export_batch"""
+        if rendering is not None:
+            for i, png in rendering:
+                pngs[i] = png
+        for i, (config, peerdata) in enumerate(configs):
+            yield f'wg_{peerdata["Id"]}.conf', config.encode('utf-8'), True
+            if pngs is not None:
+                yield f'wg_{peerdata["Id"]}.png', pngs[i], False
+
     def update_peer(self, peer, description):
         """Update the given peer"""
-        peerdata = self.wc.peers[peer]
-        first_line = peerdata['_index_firstline']
-        if self.wc.lines[first_line][0] != '#':
-            raise ValueError(f'Comment expected in first line of config for peer [{peerdata}]')
-        self.wc.lines[first_line] = '# ' + description
-        self.wc.invalidate_data()
-        self.wc.write_file()
-        self.write_qrcode(peer)
+        check_description(description)
+        with self.modifying():
+            with self.lock.writing():
+                peerdata = self.wc.peers[peer]
+                first_line = peerdata['_index_firstline']
+                if self.wc.lines[first_line][0] != '#':
+                    raise ValueError(f'Comment expected in first line of config for peer [{peerdata}]')
+                self.wc.lines[first_line] = '# ' + description
+                self.wc.invalidate_data()
+                self.unindex_peer(peer)
+                self.index_peer(peer, self.transform_to_clientdata(peer, self.wc.peers[peer]))
+                self.invalidate_cache()
+            self.write_file()
         self.config_change_done()
         return self.get_peer(peer)
         
     def delete_peer(self, peer):
         """Delete the given peer"""
-        self.wc.del_peer(peer)
-        self.wc.write_file()
+        with self.modifying():
+            with self.lock.writing():
+                self.wc.del_peer(peer)
+                self.unindex_peer(peer)
+                self.invalidate_cache()
+            self.write_file()
         self.config_change_done()
        
+    @rwlock.read_locked
     def find_free_ip(self):
-        """Find the first free address in the given network"""
-        interface_address = ipaddress.ip_interface(self.get_interface()['Address'])
-        network = interface_address.network
-        interface_address = interface_address.ip
-        addresses = [ ipaddress.ip_interface(peerdata['Address']).ip for peer, peerdata in self.get_peers().items() ]
-        ip = None
-        for addr in network.hosts():
-            if addr == interface_address:
-                continue
-            if addr in addresses:
-                continue
-            ip = addr
-            break
-        if ip is None:
-            raise ValueError('No free IP address available any more')
-        return str(ip)
-
-    def write_qrcode(self, peer):
-        """Generate a QRCode for the given peers configuration file and store in lib directory"""
+        """Find the first free address in the network of the interface"""
+        with self._cache_lock: # the pool remembers where the search starts
+            return str(self.pool.find_free()[0])
+
+    @rwlock.read_locked
+    def find_free_ips(self, count, exclude=()):
+        """Find the first "count" free addresses in the network of the interface except for the excluded ones"""
+        with self._cache_lock: # the pool remembers where the search starts
+            addresses = self.pool.find_free(count, exclude)
+        return [ str(ip) for ip in addresses ]
+
+    def find_free_ips6(self, ips):
+        """Find free IPv6 addresses for dual-stack peers with the given IPv4 addresses (to be called holding the write lock);
+           the host part of the IPv4 address is taken over if that IPv6 address is free, otherwise the lowest free one is used"""
+        offsets = [ int(ipaddress.ip_address(ip)) - int(self.pool.network.network_address) for ip in ips ]
+        ip6s = [ self.pool6.network.network_address + offset if offset < self.pool6.network.num_addresses else None for offset in offsets ]
+        ip6s = [ str(ip6) if (ip6 is not None) and self.pool6.is_free(ip6) else None for ip6 in ip6s ]
+        taken = set(ip6 for ip6 in ip6s if ip6 is not None)
+        missing = len(ip6s) - len(taken)
+        if missing:
+            free_ip6s = iter([ str(ip6) for ip6 in self.pool6.find_free(missing, exclude=taken) ])
+            ip6s = [ ip6 if ip6 is not None else next(free_ip6s) for ip6 in ip6s ]
+        return ip6s
+
+    @property
+    def pools(self):
+        """The address pools of the interface (one per IP version of a dual-stack interface)"""
+        return [ pool for pool in (self.pool, self.pool6) if pool is not None ]
+
+    def get_qrcode(self, peer):
+        """Get the QR code of the config of the given peer as PNG data together with an ETag; rendered on first request"""
         config, peerdata = self.get_peerconfig(peer)
-        #img = qrcode.make(config)
-        qr = qrcode.QRCode(version=15, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=2, border=5)
-        qr.add_data(config)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color='black', back_color='white')
-        img.save(peerdata['QRCode'])
+        etag = get_config_hash(config)
+        key = (peerdata['Id'], etag)
+        png = self.qrcodes.get(key)
+        if png is None:
+            with metrics.timer('wgfrontend_qrcode_render_duration_seconds'), profiling.phase('qrcode'):
+                png = render_qrcode(config)
+            self.qrcodes.put(key, png)
+        return png, f'"{etag}"'
 
     def config_change_done(self):
         """React on config changes"""
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""Generation and derivation of WireGuard keys (Curve25519) without forking the wg tool"""
+
+import base64
+import logging
+import os
+import wgconfig.wgexec as wgexec
+
+from . import metrics
+
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import x25519
+except ImportError:
+    x25519 = None
+
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ['auto', 'cryptography', 'python', 'wg']
+_backend = None # selected backend, determined on first use if not set explicitly
+
+# Curve25519 parameters (RFC 7748)
+_P = 2**255 - 19
+_A24 = 121665
+_BASEPOINT = 9
+
+
+def _x25519_python(scalar, u=_BASEPOINT):
+    """Pure Python X25519 scalar multiplication according to RFC 7748 (not constant-time)"""
+    k = bytearray(scalar)
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    k = int.from_bytes(k, 'little')
+    x1, x2, z2, x3, z3 = u, 1, 0, u, 1
+    swap = 0
+    for t in range(254, -1, -1):
+        k_t = (k >> t) & 1
+        swap ^= k_t
+        if swap:
+            x2, x3 = x3, x2
+            z2, z3 = z3, z2
+        swap = k_t
+        a = x2 + z2
+        aa = a * a % _P
+        b = x2 - z2
+        bb = b * b % _P
+        e = aa - bb
+        c = x3 + z3
+        d = x3 - z3
+        da = d * a % _P
+        cb = c * b % _P
+        x3 = (da + cb) ** 2 % _P
+        z3 = x1 * (da - cb) ** 2 % _P
+        x2 = aa * bb % _P
+        z2 = e * (aa + _A24 * e) % _P
+    if swap:
+        x2, x3 = x3, x2
+        z2, z3 = z3, z2
+    return (x2 * pow(z2, _P - 2, _P) % _P).to_bytes(32, 'little')
+
+def _publickey_cryptography(private_bytes):
+    """Derive the public key using the "cryptography" package"""
+    public_key = x25519.X25519PrivateKey.from_private_bytes(private_bytes).public_key()
+    return public_key.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+def set_backend(name='auto'):
+    """Select the backend for key operations ("auto", "cryptography", "python" or "wg")"""
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown key backend [{name}]')
+    if name == 'auto':
+        name = 'cryptography' if x25519 is not None else 'wg' # the built-in implementation is not constant-time, so it is only used if chosen explicitly
+    if (name == 'cryptography') and (x25519 is None):
+        logger.warning('Package "cryptography" is not available, falling back to the wg tools for key operations')
+        name = 'wg'
+    _backend = name
+    return _backend
+
+def get_backend():
+    """Get the name of the backend used for key operations"""
+    if _backend is None:
+        set_backend()
+    return _backend
+
+def generate_privatekey():
+    """Generates a WireGuard private key"""
+    backend = get_backend()
+    metrics.inc('wgfrontend_key_operations_total', backend=backend, operation='genkey')
+    if backend == 'wg':
+        metrics.inc('wgfrontend_key_subprocesses_total', operation='genkey')
+        return wgexec.generate_privatekey()
+    key = bytearray(os.urandom(32))
+    key[0] &= 248 # clamp like "wg genkey" does
+    key[31] = (key[31] & 127) | 64
+    return base64.standard_b64encode(key).decode('ascii')
+
+def get_publickey(wg_private):
+    """Gets the public key belonging to the given WireGuard private key"""
+    if wg_private is None:
+        return None
+    backend = get_backend()
+    metrics.inc('wgfrontend_key_operations_total', backend=backend, operation='pubkey')
+    if backend == 'wg':
+        metrics.inc('wgfrontend_key_subprocesses_total', operation='pubkey')
+        return wgexec.get_publickey(wg_private)
+    try:
+        private_bytes = base64.standard_b64decode(wg_private)
+    except ValueError:
+        return None
+    if len(private_bytes) != 32:
+        return None
+    if backend == 'cryptography':
+        public_bytes = _publickey_cryptography(private_bytes)
+    else:
+        public_bytes = _x25519_python(private_bytes)
+    return base64.standard_b64encode(public_bytes).decode('ascii')
+
+def generate_keypair():
+    """Generates a WireGuard key pair (returns tuple of private key and public key)"""
+    wg_private = generate_privatekey()
+    wg_public = get_publickey(wg_private)
+    return wg_private, wg_public
+
+def generate_presharedkey():
+    """Generates a WireGuard preshared key"""
+    backend = get_backend()
+    metrics.inc('wgfrontend_key_operations_total', backend=backend, operation='genpsk')
+    if backend == 'wg':
+        metrics.inc('wgfrontend_key_subprocesses_total', operation='genpsk')
+        return wgexec.generate_presharedkey()
+    return base64.standard_b64encode(os.urandom(32)).decode('ascii')
+
+
+if __name__ == '__main__':
+    # Compare the available backends
+    import shutil
+    import timeit
+    private_key = generate_privatekey()
+    backends = [ backend for backend in BACKENDS[1:] if (backend != 'cryptography') or (x25519 is not None) ]
+    if shutil.which('wg') is None:
+        backends.remove('wg')
+    for backend in backends:
+        set_backend(backend)
+        count = 10 if backend == 'wg' else 200
+        duration = timeit.timeit(lambda: get_publickey(private_key), number=count) / count
+        print(f'{backend:>12}: {duration * 1000:8.3f} ms per public key derivation ({get_publickey(private_key)})')
+        duration = timeit.timeit(lambda: (generate_keypair(), generate_presharedkey()), number=count) / count
+        print(f'{backend:>12}: {duration * 1000:8.3f} ms per generated key set')
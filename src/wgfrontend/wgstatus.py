@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+"""Runtime status of the peers of a WireGuard interface, polled in the background using "wg show <interface> dump" """
+
+import json
+import logging
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+from . import cfgstore
+
+
+logger = logging.getLogger(__name__)
+
+ONLINE_HANDSHAKE_AGE = 180 # seconds; WireGuard renews the handshake every two minutes while there is traffic
+SNAPSHOT_CHECK_INTERVAL = 1.0 # seconds between checks for a new snapshot written by the polling process
+
+
+def parse_dump(text):
+    """Parse the output of "wg show <interface> dump" into a dictionary of peer states (keyed by public key)"""
+    peers = dict()
+    lines = text.splitlines()
+    for line in lines[1:]: # the first line describes the interface
+        fields = line.split('\t')
+        if len(fields) < 8:
+            continue
+        public_key, preshared_key, endpoint, allowed_ips, latest_handshake, transfer_rx, transfer_tx, keepalive = fields[:8]
+        peers[public_key] = { 'Endpoint': None if endpoint == '(none)' else endpoint,
+                              'LatestHandshake': int(latest_handshake), # seconds since the epoch, 0 if never
+                              'TransferRx': int(transfer_rx),
+                              'TransferTx': int(transfer_tx),
+                            }
+    return peers
+
+def format_bytes(count):
+    """Format a number of bytes for display"""
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if count < 1024:
+            return f'{count:.0f} {unit}' if unit == 'B' else f'{count:.1f} {unit}'
+        count /= 1024
+    return f'{count:.1f} TiB'
+
+def format_handshake(timestamp, now=None):
+    """Format the time of the latest handshake relative to now"""
+    if not timestamp:
+        return 'never'
+    age = int((now or time.time()) - timestamp)
+    if age < 60:
+        return f'{max(age, 0)} s ago'
+    if age < 3600:
+        return f'{age // 60} min ago'
+    if age < 86400:
+        return f'{age // 3600} h ago'
+    return f'{age // 86400} d ago'
+
+
+class StatusPoller():
+    """Runs "wg show <interface> dump" periodically in a background thread and keeps the parsed result;
+       with several worker processes, only one of them polls and shares the result via "snapshot_file" """
+
+    def __init__(self, interface, wg_command='wg', interval=10.0, snapshot_file=None, active=True):
+        """Initialize for the given interface; "wg_command" is the command line for invoking the wg tool (e.g. with sudo);
+           if not "active", the snapshot is read from "snapshot_file" instead of polling"""
+        self.interface = interface
+        self.wg_command = shlex.split(wg_command)
+        self.interval = interval
+        self.snapshot_file = snapshot_file
+        self.active = active
+        self._snapshot = { 'timestamp': None, 'peers': dict() } # replaced as a whole, never modified
+        self._snapshot_mtime = None # modification time of the snapshot file read last
+        self._snapshot_checked = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._error_logged = False
+        self.polls = 0
+
+    def poll(self):
+        """Query the status of the interface once and replace the snapshot; returns whether it succeeded"""
+        command = self.wg_command + ['show', self.interface, 'dump']
+        command_text = ' '.join(command)
+        try:
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=max(self.interval, 5))
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self.log_error(f'Could not execute [{command_text}]: [{e}]')
+            return False
+        if result.returncode != 0:
+            self.log_error(f'Could not get status of interface [{self.interface}]: [{result.stderr.strip()}]')
+            return False
+        self._snapshot = { 'timestamp': time.time(), 'peers': parse_dump(result.stdout) }
+        self._error_logged = False
+        self.polls += 1
+        if self.snapshot_file is not None:
+            self.save_snapshot()
+        return True
+
+    def save_snapshot(self):
+        """Write the snapshot to the snapshot file for the other worker processes"""
+        try:
+            cfgstore.write_file_atomic(self.snapshot_file, json.dumps(self._snapshot).encode('utf-8'), mode=0o600)
+        except OSError as e:
+            logger.warning(f'Could not write status snapshot [{self.snapshot_file}]: [{e}]')
+
+    def load_snapshot(self):
+        """Take over the snapshot written by the polling process if it has changed (checked at most once per second)"""
+        now = time.monotonic()
+        if now - self._snapshot_checked < SNAPSHOT_CHECK_INTERVAL:
+            return
+        self._snapshot_checked = now
+        try:
+            mtime = os.stat(self.snapshot_file).st_mtime_ns
+            if mtime == self._snapshot_mtime:
+                return
+            with open(self.snapshot_file, 'r') as f:
+                self._snapshot = json.load(f)
+            self._snapshot_mtime = mtime
+        except (OSError, ValueError): # not written yet
+            pass
+
+    def log_error(self, message):
+        """Log an error once until polling succeeds again"""
+        if not self._error_logged:
+            logger.warning(message)
+            self._error_logged = True
+
+    def run(self):
+        """Thread function polling until stopped"""
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """Start polling in the background (not if the interval is zero or another process polls)"""
+        if (self.interval <= 0) or not self.active or ((self._thread is not None) and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='wgstatus', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get_snapshot(self):
+        """Get the latest status: "timestamp" of the poll (None if none succeeded yet) and "peers" (dictionary keyed by public key)"""
+        if not self.active:
+            self.load_snapshot()
+        return self._snapshot
+
+    def get_peer_status(self, peer):
+        """Get the latest status of the given peer (None if unknown) with the derived attribute "Online" """
+        status = self.get_snapshot()['peers'].get(peer)
+        if status is None:
+            return None
+        return dict(status, Online=(time.time() - status['LatestHandshake'] < ONLINE_HANDSHAKE_AGE))
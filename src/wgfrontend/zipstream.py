@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Generation of ZIP archives as a stream of chunks (without holding the archive in memory)"""
+
+import time
+import zipfile
+
+
+class ChunkBuffer():
+    """Write-only file object collecting the data written by ZipFile until it is taken out"""
+
+    def __init__(self):
+        """Object initialization"""
+        self._chunks = []
+        self.size = 0 # number of bytes collected
+
+    def write(self, data):
+        """Collect the given data"""
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        """Nothing to do; needed by ZipFile"""
+
+    def take(self):
+        """Get the data collected since the last call"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+def stream_zip(entries, chunk_size=65536):
+    """Generator yielding the chunks (of about "chunk_size" bytes) of a ZIP archive with the given entries;
+       "entries" is an iterable of (file name, bytes, whether to compress) tuples that is consumed lazily"""
+    buffer = ChunkBuffer()
+    date_time = time.localtime()[:6]
+    with zipfile.ZipFile(buffer, mode='w') as archive: # the buffer isn't seekable, so ZipFile writes data descriptors
+        for name, data, compress in entries:
+            info = zipfile.ZipInfo(name, date_time=date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            info.external_attr = 0o600 << 16 # the configs contain private keys
+            archive.writestr(info, data)
+            if buffer.size >= chunk_size:
+                yield buffer.take()
+    yield buffer.take() # remaining entries and central directory